@@ -0,0 +1,289 @@
+"""
+Benchmarks of the merge pipeline, on synthetic tiles served by a local XYZ
+server and a temporary MBTiles.
+
+    python -m benchmarks.run --features 500 --compare benchmarks/results/abc1234.json
+
+Results are saved as JSON, by default in benchmarks/results/<commit>.json.
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+import yaml
+
+from vt_merge_proxy.classes import ClassMatcher
+from vt_merge_proxy.config import load_config, merge_config_factory
+from vt_merge_proxy.merge import RankConfig, exclude_features, merge_tile, rank
+from vt_merge_proxy.seed import bbox_tiles
+from vt_merge_proxy.sources import LazyTile, close_http_clients
+from vt_merge_proxy.tile_in_poly import BOUNDARY, TileInPoly
+
+from .synthetic import (
+    FIELDS,
+    MERGED_CLASSES,
+    POLYGON,
+    TileServer,
+    synthetic_tiles,
+    write_mbtiles,
+)
+
+Z = 14
+
+
+def summary(name: str, times: List[float]) -> Dict[str, Any]:
+    ms = np.array(times) * 1000
+    return {
+        "name": name,
+        "iterations": len(times),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": float(ms.mean()),
+        "ops_per_s": float(len(ms) / ms.sum() * 1000),
+    }
+
+
+def measure(
+    name: str, fn: Callable[[int], Any], iterations: int, warmup: int = 5
+) -> Dict[str, Any]:
+    for i in range(warmup):
+        fn(i)
+    times = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(i)
+        times.append(time.perf_counter() - start)
+    return summary(name, times)
+
+
+async def measure_async(
+    name: str, fn: Callable[[int], Awaitable[Any]], iterations: int, warmup: int = 5
+) -> Dict[str, Any]:
+    for i in range(warmup):
+        await fn(i)
+    times = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        await fn(i)
+        times.append(time.perf_counter() - start)
+    return summary(name, times)
+
+
+def write_config(tmp: str, tilejson_url: str, partial_path: str) -> str:
+    polygon_path = os.path.join(tmp, "polygon.geojson")
+    with open(polygon_path, "w") as f:
+        json.dump(POLYGON, f)
+    classes_path = os.path.join(tmp, "classes.json")
+    with open(classes_path, "w") as f:
+        json.dump(MERGED_CLASSES, f)
+
+    config = {
+        "sources": {
+            "default": {
+                "hosts": ["localhost"],
+                "polygon": polygon_path,
+                "sources": {
+                    "full": {"tilejson_url": tilejson_url},
+                    "partial": {"mbtiles": partial_path},
+                },
+                "merge_layers": {
+                    "poi": {"fields": FIELDS, "classes": classes_path},
+                },
+                "output": {"min_zoom": Z},
+            }
+        }
+    }
+    config_path = os.path.join(tmp, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.dump(config, f)
+    return config_path
+
+
+def cpu_benchmarks(
+    tiles, full_tiles, partial_tiles, iterations: int
+) -> List[Dict[str, Any]]:
+    tile_in_poly = TileInPoly(io.StringIO(json.dumps(POLYGON)))
+    boundary = next(
+        (x, y) for x, y in tiles if tile_in_poly.tile_coverage(Z, x, y) == BOUNDARY
+    )
+    full = LazyTile(encoded=full_tiles[(Z, *boundary)], encoding="gzip")
+    partial = LazyTile(encoded=partial_tiles[(Z, *boundary)], encoding="gzip")
+    full_features = full.decoded_layer("poi").features
+    features = full_features + partial.decoded_layer("poi").features
+    classes = ClassMatcher(MERGED_CLASSES)
+
+    def points_in_poly(points):
+        return tile_in_poly.points_in_poly(Z, *boundary, points)
+
+    rng = np.random.default_rng(0)
+    points = rng.integers(0, 4096, size=(1000, 2))
+    tiles_cycle = itertools.cycle(tiles)
+
+    return [
+        measure(
+            f"decode ({len(full_features)} features)",
+            lambda i: LazyTile(full.encoded, encoding="gzip").decoded_layer("poi"),
+            iterations,
+        ),
+        measure(
+            f"rank ({len(features)} features)",
+            lambda i: rank(features, RankConfig()),
+            iterations,
+        ),
+        measure(
+            f"exclude_features ({len(full_features)} features)",
+            lambda i: exclude_features(FIELDS, full_features, classes, points_in_poly),
+            iterations,
+        ),
+        measure(
+            "TileInPoly.tile_coverage",
+            lambda i: tile_in_poly.tile_coverage(Z, *next(tiles_cycle)),
+            iterations,
+        ),
+        measure(
+            "TileInPoly.points_in_poly (1000 points)",
+            lambda i: points_in_poly(points),
+            iterations,
+        ),
+    ]
+
+
+async def io_benchmarks(config_path: str, tiles, iterations: int):
+    config = load_config(config_path)
+    mc = merge_config_factory(config["sources"]["default"])
+
+    async def merge(i):
+        x, y = tiles[i % len(tiles)]
+        return await merge_tile(
+            mc.min_zoom,
+            mc.sources[0],
+            mc.sources[1:],
+            mc.layers,
+            Z,
+            x,
+            y,
+            headers={},
+            url_params="",
+            tile_in_poly=mc.tile_in_poly,
+        )
+
+    results = [await measure_async("merge_tile", merge, iterations)]
+
+    # The server reads its config on import
+    os.environ["CONFIG"] = config_path
+    import httpx
+
+    from vt_merge_proxy.server import app
+
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://localhost"
+    ) as client:
+
+        async def get(i):
+            x, y = tiles[i % len(tiles)]
+            r = await client.get(
+                f"/data/default/{Z}/{x}/{y}.pbf", headers={"Accept-Encoding": "gzip"}
+            )
+            r.raise_for_status()
+
+        results.append(await measure_async("GET tile", get, iterations))
+
+        async def get_metatile(i):
+            x, y = tiles[i % len(tiles)]
+            r = await client.get(f"/data/default/{Z - 2}/{x >> 2}/{y >> 2}.tar?depth=2")
+            r.raise_for_status()
+
+        results.append(
+            await measure_async(
+                "GET metatile (16 tiles)", get_metatile, max(iterations // 16, 1)
+            )
+        )
+
+    await close_http_clients()
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results: List[Dict[str, Any]], previous: Optional[Dict[str, Any]]):
+    previous_by_name = {r["name"]: r for r in (previous or {}).get("results", [])}
+    print(f"{'benchmark':45} {'p50 ms':>9} {'p99 ms':>9} {'ops/s':>10}")
+    for r in results:
+        line = (
+            f"{r['name']:45} {r['p50_ms']:9.3f} {r['p99_ms']:9.3f}"
+            f" {r['ops_per_s']:10.0f}"
+        )
+        if r["name"] in previous_by_name:
+            ratio = r["p50_ms"] / previous_by_name[r["name"]]["p50_ms"]
+            line += f"  p50 x{ratio:.2f}"
+        print(line)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--features", type=int, default=500, help="POI per full tile")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--output", help="Results JSON file")
+    parser.add_argument("--compare", help="Previous results JSON file")
+    args = parser.parse_args(argv)
+
+    tiles = sorted(bbox_tiles(Z, (-1.10, 43.68, -1.00, 43.75)))
+    full_tiles, partial_tiles = synthetic_tiles(
+        [(Z, x, y) for x, y in tiles], args.features
+    )
+
+    results = cpu_benchmarks(tiles, full_tiles, partial_tiles, args.iterations)
+    with tempfile.TemporaryDirectory() as tmp, TileServer(full_tiles) as server:
+        partial_path = os.path.join(tmp, "partial.mbtiles")
+        write_mbtiles(partial_path, partial_tiles)
+        config_path = write_config(tmp, server.url + "/tilejson.json", partial_path)
+        results += asyncio.run(io_benchmarks(config_path, tiles, args.iterations))
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": {"features": args.features, "iterations": args.iterations},
+        "results": results,
+    }
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_results(results, previous)
+
+    output = args.output or os.path.join(
+        os.path.dirname(__file__), "results", f"{commit}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved in {output}")
+
+
+if __name__ == "__main__":
+    main()
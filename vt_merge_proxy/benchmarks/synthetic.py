@@ -0,0 +1,165 @@
+"""
+Synthetic vector tiles and sources, for reproducible benchmarks.
+"""
+import gzip
+import hashlib
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+import vector_tile_base  # type: ignore
+
+from vt_merge_proxy.mbtiles import MBTilesWriter
+
+FIELDS = ["superclass", "class"]
+# Classes of the features replaced by the partial source
+MERGED_CLASSES = [["amenity", "restaurant"], ["tourism", "hotel"]]
+OTHER_CLASSES = [["amenity", "school"], ["shop", "bakery"], ["leisure", "park"]]
+
+# Around a few tiles at zoom 14
+POLYGON = {
+    "type": "Polygon",
+    "coordinates": [
+        [
+            [-1.10, 43.68],
+            [-1.00, 43.68],
+            [-1.02, 43.74],
+            [-1.08, 43.75],
+            [-1.10, 43.68],
+        ]
+    ],
+}
+
+Tiles = Dict[Tuple[int, int, int], bytes]
+
+
+def synthetic_tile(
+    rng: random.Random,
+    features: int,
+    classes: List[List[str]],
+    other_layers: int = 2,
+    other_features: int = 200,
+) -> bytes:
+    """
+    Tile with a "poi" layer of point features of the classes, and other layers
+    of line strings.
+    """
+    tile = vector_tile_base.VectorTile()
+    layer = tile.add_layer("poi")
+    for i in range(features):
+        feature = layer.add_point_feature()
+        feature.add_points([[rng.randrange(0, 4096), rng.randrange(0, 4096)]])
+        superclass, classs = rng.choice(classes)
+        feature.attributes = {
+            "superclass": superclass,
+            "class": classs,
+            "name": f"POI {i}",
+            "zoom": rng.randrange(14, 19),
+            "priority": rng.randrange(0, 100),
+        }
+        feature.id = i + 1
+
+    for n in range(other_layers):
+        layer = tile.add_layer(f"layer_{n}")
+        for i in range(other_features):
+            feature = layer.add_line_string_feature()
+            feature.add_line_string(
+                [[rng.randrange(0, 4096), rng.randrange(0, 4096)] for _ in range(8)]
+            )
+            feature.attributes = {"kind": f"kind {i % 10}"}
+            feature.id = i + 1
+
+    return tile.serialize()
+
+
+def synthetic_tiles(
+    tiles: List[Tuple[int, int, int]], features: int, seed: int = 0
+) -> Tuple[Tiles, Tiles]:
+    """
+    Gzipped full and partial tiles, the partial ones with a quarter of the
+    features, all of the merged classes.
+    """
+    rng = random.Random(seed)
+    full = {
+        tile: gzip.compress(
+            synthetic_tile(rng, features, MERGED_CLASSES + OTHER_CLASSES), mtime=0
+        )
+        for tile in tiles
+    }
+    partial = {
+        tile: gzip.compress(
+            synthetic_tile(rng, features // 4, MERGED_CLASSES, other_layers=0),
+            mtime=0,
+        )
+        for tile in tiles
+    }
+    return full, partial
+
+
+def write_mbtiles(path: str, tiles: Tiles):
+    writer = MBTilesWriter(path)
+    writer.write_metadata({"name": "partial", "format": "pbf"})
+    for (z, x, y), tile_data in tiles.items():
+        writer.write_tiles(z, [(x, y, tile_data)])
+    writer.close()
+
+
+class TileServer:
+    """
+    Local stand-in of an XYZ tile server with a TileJSON.
+    """
+
+    def __init__(self, tiles: Tiles):
+        self.tiles = tiles
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                body, headers = server.response(self.path)
+                self.send_response(200 if body is not None else 404)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body or b"")))
+                self.end_headers()
+                self.wfile.write(body or b"")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def response(self, path: str):
+        if path == "/tilejson.json":
+            tilejson = {
+                "tilejson": "2.2.0",
+                "tiles": [self.url + "/{z}/{x}/{y}.pbf"],
+                "vector_layers": [{"id": "poi"}, {"id": "layer_0"}, {"id": "layer_1"}],
+            }
+            return json.dumps(tilejson).encode(), {"Content-Type": "application/json"}
+
+        try:
+            z, x, y = map(int, path[1:].replace(".pbf", "").split("/"))
+        except ValueError:
+            return None, {}
+        tile_data = self.tiles.get((z, x, y))
+        if tile_data is None:
+            return None, {}
+        return tile_data, {
+            "Content-Type": "application/vnd.vector-tile",
+            "Content-Encoding": "gzip",
+            "ETag": '"' + hashlib.md5(tile_data).hexdigest() + '"',
+        }
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -155,12 +155,26 @@ setup(
     # Essential details on the package and its dependencies
     name=meta["name"],
     version=meta["version"],
-    packages=find_packages(exclude=["tests", "*.tests", "*.tests.*", "tests.*"]),
+    packages=find_packages(
+        exclude=[
+            "tests",
+            "*.tests",
+            "*.tests.*",
+            "tests.*",
+            "benchmarks",
+            "benchmarks.*",
+        ]
+    ),
     package_dir={meta["name"]: os.path.join(".", meta["path"])},
     # If any package contains *.txt or *.rst files, include them:
     # package_data={'': ['*.txt', '*.rst'],}
     install_requires=install_requires,
     extras_require=extras_require,
+    entry_points={
+        "console_scripts": [
+            "vt-merge-seed = vt_merge_proxy.seed:main",
+        ],
+    },
     # Metadata to display on PyPI
     author=meta["author"],
     author_email=meta["author_email"],
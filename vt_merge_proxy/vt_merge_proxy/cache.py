@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+from .metrics import count_cache_lookup
+
+
+class LRUCache:
+    """
+    Least recently used cache, bounded by the total size of its entries.
+    Entries expire after ttl seconds. Safe to share with the merge threads.
+
+    Hits and misses of a named cache are also exported as Prometheus metrics.
+    """
+
+    def __init__(
+        self, max_size: int, ttl: Optional[float] = None, name: Optional[str] = None
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int, Optional[float]]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            return self._get(key, default)
+
+    def _get(self, key: Hashable, default):
+        entry = self._entries.get(key)
+        if entry is None:
+            self._count("miss")
+            return default
+
+        value, size, expire = entry
+        if expire is not None and expire < time.monotonic():
+            self._remove(key)
+            self._count("miss")
+            return default
+
+        self._entries.move_to_end(key)
+        self._count("hit")
+        return value
+
+    def _count(self, result: str):
+        if result == "hit":
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.name:
+            count_cache_lookup(self.name, result)
+
+    def set(self, key: Hashable, value, size: int):
+        with self._lock:
+            self._set(key, value, size)
+
+    def _set(self, key: Hashable, value, size: int):
+        if key in self._entries:
+            self._remove(key)
+        if size > self.max_size:
+            return
+
+        expire = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (value, size, expire)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
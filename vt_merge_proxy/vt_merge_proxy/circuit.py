@@ -0,0 +1,75 @@
+import time
+from typing import Optional
+
+
+class CircuitOpenError(Exception):
+    """
+    The upstream was not called, its circuit is open after too many failures.
+    """
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable, retry after {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Health of an upstream. Closed, calls pass and the consecutive failures are
+    counted. Open after failure_threshold of them, calls fail fast for
+    reset_timeout seconds. Then half open, a single trial call closes it on
+    success or opens it again. A trial call without outcome, eg. cancelled,
+    must be released for an other one.
+    """
+
+    def __init__(
+        self, name: str, failure_threshold: int = 5, reset_timeout: float = 30
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        elif self._opened_at + self.reset_timeout <= time.monotonic():
+            return "half_open"
+        else:
+            return "open"
+
+    def check(self):
+        """
+        Raise CircuitOpenError unless the call may go to the upstream.
+        """
+        state = self.state
+        if state == "closed":
+            return
+        elif state == "half_open" and not self._trial:
+            self._trial = True
+            return
+        assert self._opened_at is not None
+        raise CircuitOpenError(
+            self.name,
+            max(self._opened_at + self.reset_timeout - time.monotonic(), 1),
+        )
+
+    def success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._trial = False
+
+    def release(self):
+        """
+        End a call without outcome.
+        """
+        self._trial = False
@@ -0,0 +1,46 @@
+from typing import Any, Dict, List
+
+_END = object()
+
+
+def _hashable(value):
+    return tuple(map(_hashable, value)) if isinstance(value, list) else value
+
+
+class ClassMatcher:
+    """
+    Classes of features compiled into a prefix trie on the fields values. A
+    feature matches when one of the classes is a prefix of its fields values.
+    """
+
+    def __init__(self, classes: List[List[Any]]):
+        self.classes = classes
+        self._trie: Dict[Any, Any] = {}
+        for classs in classes:
+            node = self._trie
+            for value in classs:
+                node = node.setdefault(_hashable(value), {})
+            node[_END] = True
+
+    def __bool__(self):
+        return bool(self.classes)
+
+    def match(self, fields: List[str], attributes) -> bool:
+        node = self._trie
+        if _END in node:
+            return True
+
+        for field in fields:
+            value = _hashable(attributes[field]) if field in attributes else None
+            try:
+                child = node.get(value)
+            except TypeError:
+                # Unhashable value, eg. a map, matches no class
+                return False
+            if child is None:
+                return False
+            elif _END in child:
+                return True
+            node = child
+
+        return False
@@ -0,0 +1,73 @@
+import gzip
+from typing import Any, Dict, Optional, Set
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+# Compression of merged tiles
+compression_config: Dict[str, Any] = {
+    "encoding": "gzip",
+    "level": 6,
+}
+
+
+def configure_compression(**kwargs):
+    compression_config.update(kwargs)
+    if compression_config["encoding"] not in supported_encodings():
+        raise ValueError(f"Unsupported encoding {compression_config['encoding']}")
+
+
+def compression_level(encoding: str) -> Optional[int]:
+    if compression_config["encoding"] == encoding:
+        return compression_config["level"]
+    else:
+        return None
+
+
+def supported_encodings() -> Set[str]:
+    return {"gzip", "br"} if brotli else {"gzip"}
+
+
+def compress(data: bytes, encoding: str, level: Optional[int] = None) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9 if level is None else level, mtime=0)
+    elif encoding == "br" and brotli:
+        return brotli.compress(data, quality=11 if level is None else level)
+    else:
+        raise ValueError(f"Unsupported encoding {encoding}")
+
+
+def decompress(data: bytes, encoding: Optional[str]) -> bytes:
+    if not encoding or encoding == "identity":
+        return data
+    elif encoding == "gzip":
+        return gzip.decompress(data)
+    elif encoding == "br" and brotli:
+        return brotli.decompress(data)
+    else:
+        raise ValueError(f"Unsupported encoding {encoding}")
+
+
+def accepted_encodings(accept_encoding: Optional[str]) -> Set[str]:
+    """
+    Parse an Accept-Encoding header, only encodings with a null weight are
+    refused.
+    """
+    encodings = set()
+    for coding in (accept_encoding or "").split(","):
+        name, *params = [p.strip() for p in coding.split(";")]
+        weight = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    weight = float(param[2:])
+                except ValueError:
+                    weight = 0
+        if name and weight > 0:
+            encodings.add(name.lower())
+
+    if "*" in encodings:
+        encodings |= supported_encodings()
+    return encodings
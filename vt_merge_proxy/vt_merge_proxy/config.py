@@ -0,0 +1,110 @@
+import hashlib
+import json
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import yaml
+
+from .classes import ClassMatcher
+from .merge import RankConfig
+from .sources import Source, sourceFactory
+from .tile_in_poly import TileInPoly
+
+
+def load_config(path: str):
+    config = yaml.load(open(path).read(), Loader=yaml.UnsafeLoader)
+    if not config.get("server"):
+        config["server"] = {}
+    return config
+
+
+@dataclass
+class LayerConfig(object):
+    fields: List[str]
+    classes: Optional[ClassMatcher]
+    rank: RankConfig
+    # Merged after the lower precedences, default to the partial source order
+    precedence: int
+
+
+@dataclass
+class MergeConfig(object):
+    sources: List[Source]
+    min_zoom: int
+    tile_in_poly: Optional[TileInPoly]
+    # Merge layers of each partial source, sources[1:]
+    layers: List[Dict[str, LayerConfig]]
+    config_version: str
+    # Serve the full tile as is when a partial source fails
+    degrade_partials: bool = False
+
+    def version(self) -> str:
+        """
+        Version of the merged tiles, changes with the config or the content of
+        the sources.
+        """
+        return ",".join(
+            [self.config_version] + [source.version() or "" for source in self.sources]
+        )
+
+
+def partial_merge_layers(source_conf) -> List[Dict[str, Any]]:
+    """
+    Merge layers of the partial sources, default to the shared ones.
+    """
+    return [
+        source.get("merge_layers") or source_conf.get("merge_layers") or {}
+        for source in list(source_conf["sources"].values())[1:]
+    ]
+
+
+def config_version(source_conf) -> str:
+    h = hashlib.blake2b(digest_size=8)
+    h.update(json.dumps(source_conf, sort_keys=True, default=str).encode())
+    for merge_layers in partial_merge_layers(source_conf):
+        for merge_layer in merge_layers.values():
+            if merge_layer and merge_layer.get("classes"):
+                h.update(open(merge_layer["classes"], "rb").read())
+    return h.hexdigest()
+
+
+def merge_config_factory(source_conf, with_sources: bool = True) -> MergeConfig:
+    """
+    Without sources, for the merge workers, which only need the layers.
+    """
+    tile_in_poly = None
+    if "polygon" in source_conf:
+        tile_in_poly = TileInPoly(
+            open(source_conf["polygon"]),
+            index_max_zoom=int(source_conf.get("polygon_index_max_zoom", 14)),
+        )
+
+    return MergeConfig(
+        sources=[sourceFactory(source) for source in source_conf["sources"].values()]
+        if with_sources
+        else [],
+        min_zoom=int(source_conf["output"]["min_zoom"]),
+        tile_in_poly=tile_in_poly,
+        layers=[
+            {
+                layer: LayerConfig(
+                    fields=merge_layer and merge_layer.get("fields"),
+                    classes=merge_layer
+                    and merge_layer.get("classes")
+                    and ClassMatcher(
+                        json.loads(open(merge_layer["classes"], "r").read())
+                    ),
+                    rank=RankConfig(
+                        **((merge_layer and merge_layer.get("rank")) or {})
+                    ),
+                    precedence=int(
+                        merge_layer.get("precedence", i) if merge_layer else i
+                    ),
+                )
+                for layer, merge_layer in merge_layers.items()
+            }
+            for i, merge_layers in enumerate(partial_merge_layers(source_conf))
+        ],
+        config_version=config_version(source_conf),
+        degrade_partials=bool(source_conf.get("degrade_partials")),
+    )
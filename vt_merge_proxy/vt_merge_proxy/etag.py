@@ -0,0 +1,36 @@
+import hashlib
+from typing import Optional, Union
+
+
+def make_etag(*parts: Union[bytes, str, None]) -> str:
+    """
+    Opaque entity tag, without quotes, hashed from the parts.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if part is None:
+            part = b""
+        elif isinstance(part, str):
+            part = part.encode()
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    If-None-Match header comparison, weak as required by RFC 7232 section 3.2.
+    The encoding suffix of the tile ETags is ignored.
+    """
+    if not if_none_match:
+        return False
+
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag.strip('"').split("-")[0] == etag:
+            return True
+    return False
@@ -0,0 +1,207 @@
+"""
+Run the CPU part of the merges, decode, filter, rank and encode, out of the
+event loop, on a thread or a process pool.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from .cache import LRUCache
+from .config import load_config, merge_config_factory
+from .merge import merge_tile_data
+from .metrics import Records, recording, replay
+from .sources import LazyTile
+from .tile_in_poly import TileInPoly
+
+# Picklable tile: bytes, encoding of the bytes and etag
+TileParts = Optional[Tuple[bytes, Optional[str], Optional[str]]]
+
+
+def tile_parts(tile: Optional[LazyTile]) -> TileParts:
+    if tile is None:
+        return None
+    elif tile.encoding and tile.encoded is not None:
+        return tile.encoded, tile.encoding, tile.etag
+    else:
+        return tile.raw, None, tile.etag
+
+
+def parts_tile(parts: TileParts) -> Optional[LazyTile]:
+    if parts is None:
+        return None
+    data, encoding, etag = parts
+    if encoding:
+        return LazyTile(encoded=data, encoding=encoding, etag=etag)
+    else:
+        return LazyTile(raw=data, etag=etag)
+
+
+def feature_cache_factory(feature_cache_conf) -> Optional[LRUCache]:
+    if not feature_cache_conf:
+        return None
+    return LRUCache(
+        max_size=int(feature_cache_conf["max_size"]),
+        ttl=feature_cache_conf.get("ttl"),
+        name="feature",
+    )
+
+
+# State of the worker processes
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(config_path: str):
+    config = load_config(config_path)
+    _worker["merge_configs"] = {
+        data_id: merge_config_factory(source_conf, with_sources=False)
+        for data_id, source_conf in config["sources"].items()
+    }
+    _worker["feature_cache"] = feature_cache_factory(
+        config["server"].get("feature_cache")
+    )
+
+
+def _merge_tile_data(
+    data_id: str,
+    full: TileParts,
+    partials: List[TileParts],
+    z: int,
+    x: int,
+    y: int,
+    in_poly: bool,
+    url_params: str,
+) -> Tuple[Optional[int], TileParts, Records]:
+    """
+    Merge in a worker process. A source tile returned as is is sent back by
+    its index only, full one first. The metrics are sent back as records, to
+    be observed by the server process.
+    """
+    mc = _worker["merge_configs"][data_id]
+    full_data = parts_tile(full)
+    partial_datas = [parts_tile(partial) for partial in partials]
+    with recording() as records:
+        tile = merge_tile_data(
+            full_data,
+            partial_datas,
+            mc.layers,
+            z,
+            x,
+            y,
+            mc.tile_in_poly if in_poly else None,
+            _worker["feature_cache"],
+            cache_keys=[
+                (data_id, i, url_params, z, x, y) for i in range(1 + len(partials))
+            ],
+        )
+    for i, source_data in enumerate([full_data] + partial_datas):
+        if tile is source_data:
+            return i, None, records
+    return None, tile_parts(tile), records
+
+
+class MergeExecutor:
+    """
+    Pool running merge_tile_data(). Threads share the tiles and the feature
+    cache, but the GIL. Processes merge in parallel from the tile bytes, with
+    their own copy of the config, loaded from config_path.
+    """
+
+    def __init__(
+        self,
+        type: str = "thread",
+        workers: Optional[int] = None,
+        config_path: Optional[str] = None,
+    ):
+        self.type = type
+        self.executor: Executor
+        if type == "thread":
+            self.executor = ThreadPoolExecutor(workers)
+        elif type == "process":
+            if not config_path:
+                raise ValueError("A process merge executor requires the config path")
+            # Each worker process holds its own feature cache
+            self.executor = ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(config_path,)
+            )
+        else:
+            raise ValueError(f"Unknown merge executor type {type}")
+
+    async def merge(
+        self,
+        data_id: str,
+        full_data: Optional[LazyTile],
+        partial_datas: List[Optional[LazyTile]],
+        layers,
+        z: int,
+        x: int,
+        y: int,
+        tile_in_poly: Optional[TileInPoly],
+        feature_cache: Optional[LRUCache],
+        cache_keys: Optional[List[Tuple]] = None,
+        url_params: str = "",
+    ) -> Optional[LazyTile]:
+        """
+        merge_tile_data() of a tile of the config source data_id. Bind the
+        data_id to use it as the executor of merge_tile().
+        """
+        loop = asyncio.get_running_loop()
+        if self.type == "thread":
+            # Keep the metrics labels of the request
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(
+                self.executor,
+                functools.partial(
+                    context.run,
+                    merge_tile_data,
+                    full_data,
+                    partial_datas,
+                    layers,
+                    z,
+                    x,
+                    y,
+                    tile_in_poly,
+                    feature_cache,
+                    cache_keys,
+                ),
+            )
+
+        index, parts, records = await loop.run_in_executor(
+            self.executor,
+            functools.partial(
+                _merge_tile_data,
+                data_id,
+                tile_parts(full_data),
+                [tile_parts(partial_data) for partial_data in partial_datas],
+                z,
+                x,
+                y,
+                tile_in_poly is not None,
+                url_params,
+            ),
+        )
+        # In the context of the request, with its labels
+        replay(records)
+        if index is not None:
+            return ([full_data] + partial_datas)[index]
+        return parts_tile(parts)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def merge_executor_factory(
+    merge_executor_conf, config_path: str
+) -> Optional[MergeExecutor]:
+    """
+    Default to merge inline, on the event loop.
+    """
+    if not merge_executor_conf or merge_executor_conf.get("type", "inline") == "inline":
+        return None
+    return MergeExecutor(
+        type=merge_executor_conf["type"],
+        workers=merge_executor_conf.get("workers") or os.cpu_count(),
+        config_path=config_path,
+    )
@@ -0,0 +1,165 @@
+import asyncio
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, Optional, Set, Tuple, TypeVar
+from urllib.parse import quote
+
+T = TypeVar("T")
+
+# Shared by all the MBTiles, SQLite and zlib release the GIL
+executor = ThreadPoolExecutor(thread_name_prefix="mbtiles")
+
+
+def _reset_executor():
+    # The threads of the parent do not exist in a forked worker process
+    global executor
+    executor = ThreadPoolExecutor(thread_name_prefix="mbtiles")
+
+
+os.register_at_fork(after_in_child=_reset_executor)
+
+
+class MBTilesReader:
+    """
+    Read only access to an MBTiles file, in XYZ tile coordinates.
+
+    Each thread gets its own connection, opened in immutable mode and with
+    memory mapped I/O. Queries use constant SQL, so statements are prepared
+    once per connection by the sqlite3 statement cache. As immutable mode
+    does not see changes, connections are opened again when the file is
+    replaced.
+    """
+
+    def __init__(self, path: str, mmap_size: int = 1 << 30):
+        self.path = path
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+
+    def _file_version(self) -> Tuple[int, int, int]:
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def version(self) -> str:
+        return str(os.stat(self.path).st_mtime_ns)
+
+    def _connection(self) -> sqlite3.Connection:
+        version = self._file_version()
+        if getattr(self._local, "version", None) != version:
+            if getattr(self._local, "connection", None):
+                self._local.connection.close()
+
+            connection = sqlite3.connect(
+                f"file:{quote(os.path.abspath(self.path))}?mode=ro&immutable=1",
+                uri=True,
+            )
+            connection.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+            self._local.connection = connection
+            self._local.version = version
+        return self._local.connection
+
+    def read_tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+        row = (
+            self._connection()
+            .execute(
+                "SELECT tile_data FROM tiles "
+                "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (z, x, 2 ** z - 1 - y),
+            )
+            .fetchone()
+        )
+        return row and row[0]
+
+    def read_tiles(
+        self, z: int, tiles: Iterable[Tuple[int, int]]
+    ) -> Dict[Tuple[int, int], bytes]:
+        """
+        Read many tiles of a zoom level in one query, on their bounding box.
+        """
+        tiles = set(tiles)
+        if not tiles:
+            return {}
+
+        xs = [x for x, _ in tiles]
+        ys = [2 ** z - 1 - y for _, y in tiles]
+        rows = (
+            self._connection()
+            .execute(
+                "SELECT tile_column, tile_row, tile_data FROM tiles "
+                "WHERE zoom_level = ? AND "
+                "tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?",
+                (z, min(xs), max(xs), min(ys), max(ys)),
+            )
+            .fetchall()
+        )
+        read = {(x, 2 ** z - 1 - y): tile_data for x, y, tile_data in rows}
+        return {tile: read[tile] for tile in tiles if tile in read}
+
+    def read_tile_coords(self) -> Iterator[Tuple[int, int, int]]:
+        """
+        Coordinates of all the tiles.
+        """
+        for z, x, row in self._connection().execute(
+            "SELECT zoom_level, tile_column, tile_row FROM tiles"
+        ):
+            yield z, x, 2 ** z - 1 - row
+
+    def metadata(self) -> Dict[str, str]:
+        return dict(
+            self._connection().execute("SELECT name, value FROM metadata").fetchall()
+        )
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        """
+        Run a blocking read function out of the event loop.
+        """
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+class MBTilesWriter:
+    """
+    Write tiles to an MBTiles file, in XYZ tile coordinates. Each batch of
+    tiles is written in one transaction.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            """
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+            CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name);
+            CREATE TABLE IF NOT EXISTS tiles (
+                zoom_level INTEGER,
+                tile_column INTEGER,
+                tile_row INTEGER,
+                tile_data BLOB
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS tile_index
+                ON tiles (zoom_level, tile_column, tile_row);
+            """
+        )
+
+    def existing_tiles(self, z: int) -> Set[Tuple[int, int]]:
+        rows = self.connection.execute(
+            "SELECT tile_column, tile_row FROM tiles WHERE zoom_level = ?", (z,)
+        )
+        return {(x, 2 ** z - 1 - y) for x, y in rows}
+
+    def write_tiles(self, z: int, tiles: Iterable[Tuple[int, int, bytes]]):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                [(z, x, 2 ** z - 1 - y, tile_data) for x, y, tile_data in tiles],
+            )
+
+    def write_metadata(self, metadata: Dict[str, str]):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?)", metadata.items()
+            )
+
+    def close(self):
+        self.connection.close()
@@ -1,104 +1,130 @@
+import asyncio
 import copy
+import functools
+import logging
 import random
-from typing import Dict, List, Optional
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 
+import httpx
+import numpy as np
 import vector_tile_base  # type: ignore
 
-from .tile_in_poly import TileInPoly
+from .cache import LRUCache
+from .circuit import CircuitOpenError
+from .classes import ClassMatcher
+from .etag import make_etag
+from .metrics import count_tile, stage
+from .sources import LazyTile, SourceMBTiles, SourcePrefetched
+from .tile_in_poly import INSIDE, OUTSIDE, TileInPoly
 
+logger = logging.getLogger(__name__)
 
-# Monkey patch
-def FeatureAttributes___setitem__(self, key, value):
-    if not isinstance(key, str) and not isinstance(key, bytes):
-        raise TypeError("Keys must be of type str or bytes")
-    self._decode_attr()
-    self._attr[key] = value
-    # self._encode_attr() # Disable encoding at each __setitem__()
-
-
-vector_tile_base.FeatureAttributes.__setitem__ = FeatureAttributes___setitem__
-
-
-def layer_extract(tile, layer_name: str):
-    return next(filter(lambda layer: layer.name == layer_name, tile.layers), None)
+Selector = Callable[[List[object]], List[object]]
 
 
 def get_attribute(attributes, key: str, default=None):
     return default if key not in attributes else attributes[key]
 
 
-def get_classes(fields, feature):
-    attributes = feature.attributes
-    return [get_attribute(attributes, field) for field in fields]
-
-
-def match_class_list(fields, feature, classes):
-    feature_class = get_classes(fields, feature)
-    return any(map(lambda classs: classs == feature_class[: len(classs)], classes))
-
-
-def include_feature(fields, feature, classes, point_in_poly):
-    if not point_in_poly or point_in_poly(*feature.get_points()[0]):
-        return match_class_list(fields, feature, classes)
-    else:
-        return False
+def match_class_list(fields, feature, classes: ClassMatcher):
+    return classes.match(fields, feature.attributes)
+
+
+def include_features_mask(
+    fields,
+    features,
+    classes,
+    points_in_poly: Optional[Callable[[np.ndarray], np.ndarray]],
+) -> np.ndarray:
+    """
+    Boolean mask of the features matching the classes and in the polygon.
+    Only the matching features are tested against the polygon, at once.
+    """
+    with stage("classes"):
+        mask = np.fromiter(
+            (match_class_list(fields, feature, classes) for feature in features),
+            dtype=bool,
+            count=len(features),
+        )
+    if points_in_poly and mask.any():
+        with stage("polygon"):
+            matches = np.flatnonzero(mask)
+            points = np.array(
+                [features[i].get_points()[0] for i in matches], dtype=float
+            ).reshape(-1, 2)
+            mask[matches] = points_in_poly(points)
+    return mask
 
 
-def exclude_features(fields, features, classes, point_in_poly):
+def exclude_features(fields, features, classes, points_in_poly):
     if classes:
-        return list(
-            filter(
-                lambda feature: not include_feature(
-                    fields, feature, classes, point_in_poly
-                ),
-                features,
-            )
-        )
+        mask = include_features_mask(fields, features, classes, points_in_poly)
+        return [feature for feature, include in zip(features, mask) if not include]
     else:
         return features
 
 
-def include_features(fields, features, classes, point_in_poly):
+def all_features(features):
+    return features
+
+
+def include_features(fields, features, classes, points_in_poly):
     if classes:
-        return list(
-            filter(
-                lambda feature: include_feature(
-                    fields, feature, classes, point_in_poly
-                ),
-                features,
-            )
-        )
+        mask = include_features_mask(fields, features, classes, points_in_poly)
+        return [feature for feature, include in zip(features, mask) if include]
     else:
         return []
 
 
-# FIXME hardcoded fields
-def rank(features):
-    grid = {}
-    for f in features:
-        x, y = f.get_geometry()[0]
-        x = (x + 50) // 100
-        y = (y + 50) // 100
-        h = (x, y)
-        if h not in grid:
-            grid[h] = []
-        grid[h].append(f)
-
-    for _, group_features in grid.items():
-        poi = sorted(
-            group_features,
-            key=lambda a: [
-                get_attribute(a.attributes, "zoom", 18),
-                get_attribute(a.attributes, "priority", 9999),
+@dataclass
+class RankConfig(object):
+    grid_size: int = 100
+    sort: List[Dict[str, Any]] = field(
+        default_factory=lambda: [
+            {"field": "zoom", "default": 18},
+            {"field": "priority", "default": 9999},
+        ]
+    )
+    attribute: str = "rank"
+
+
+def rank(features, config: RankConfig = RankConfig()) -> List[int]:
+    """
+    Rank features by sort fields in each cell of a grid.
+    """
+    if len(features) == 0:
+        return []
+
+    points = np.array([f.get_geometry()[0] for f in features]).reshape(-1, 2)
+    cells = (points + config.grid_size // 2) // config.grid_size
+    sort_values = [
+        np.array(
+            [
+                get_attribute(f.attributes, sort["field"], sort.get("default"))
+                for f in features
             ],
+            dtype=float,
         )
-        for rank, feature in enumerate(poi):
-            feature.attributes["rank"] = rank  # Monkey patched to disable encoding
+        for sort in config.sort
+    ]
+
+    # Last key is the primary one, lexsort is stable
+    order = np.lexsort(tuple(reversed(sort_values)) + (cells[:, 1], cells[:, 0]))
+    sorted_cells = cells[order]
+    cell_start = np.concatenate(
+        ([True], np.any(sorted_cells[1:] != sorted_cells[:-1], axis=1))
+    )
+    positions = np.arange(len(features))
+    cell_start_position = np.maximum.accumulate(np.where(cell_start, positions, 0))
 
-    return features
+    ranks = np.empty(len(features), dtype=int)
+    ranks[order] = positions - cell_start_position
+    return ranks.tolist()
 
 
-def build_feature(merge_tile_layer, f):
+def build_feature(merge_tile_layer, f, attributes: Dict[str, Any]):
     if f.type == "point":
         feature = merge_tile_layer.add_point_feature()
         feature.add_points(f.get_geometry())
@@ -118,141 +144,529 @@ def build_feature(merge_tile_layer, f):
         raise Exception(f.type)
 
     feature.id = f.id if f.id is not None else random.randrange(2 ** 32)
-    # FIXME decode/encode to be done only if changed
     f.attributes._decode_attr()
-    # FIXME Attribut re-encoding : slowest step
+    # Attribut re-encoding : slowest step
     # https://github.com/mapbox/vector-tile-base/blob/master/vector_tile_base/engine.py#L251
-    feature.attributes = f.attributes._attr
+    feature.attributes = dict(f.attributes._attr, **attributes)
+
+
+class LayerBuilder:
+    """
+    Add features to a layer by copying their protobuf geometry and tags. The
+    keys and values tables of the source layers are remapped once to the ones
+    of the built layer, attributes are neither decoded nor encoded again.
+
+    Layers with inline attributes (vector tile version 3) fall back to
+    build_feature().
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+        self._layer = layer._layer
+        self._keys: Dict[str, int] = {}
+        self._values: Dict[bytes, int] = {}
+        self._remaps: Dict[int, Tuple[Any, List, List]] = {}
+
+    def _key(self, key: str) -> int:
+        index = self._keys.get(key)
+        if index is None:
+            index = self._keys[key] = len(self._layer.keys)
+            self._layer.keys.append(key)
+        return index
+
+    def _value(self, value) -> int:
+        serialized = value.SerializeToString()
+        index = self._values.get(serialized)
+        if index is None:
+            index = self._values[serialized] = len(self._layer.values)
+            self._layer.values.add().CopyFrom(value)
+        return index
+
+    def _int_value(self, value: int) -> int:
+        new_value = self._layer.values.add()
+        if value < 0:
+            new_value.sint_value = value
+        else:
+            new_value.uint_value = value
+        serialized = new_value.SerializeToString()
+        index = self._values.get(serialized)
+        if index is None:
+            index = self._values[serialized] = len(self._layer.values) - 1
+        else:
+            del self._layer.values[-1]
+        return index
+
+    def _remap(self, source_layer):
+        remap = self._remaps.get(id(source_layer))
+        if remap is None:
+            # Keep a reference on the source layer, its id() stays unique
+            remap = self._remaps[id(source_layer)] = (
+                source_layer,
+                [None] * len(source_layer.keys),
+                [None] * len(source_layer.values),
+            )
+        return remap
+
+    def add_feature(self, f, attributes: Dict[str, int]):
+        if getattr(f._layer, "_inline_attributes", False) or getattr(
+            self.layer, "_inline_attributes", False
+        ):
+            build_feature(self.layer, f, attributes)
+            return
+
+        source_layer, keys, values = self._remap(f._layer._layer)
+        added_keys = [self._key(key) for key in attributes.keys()]
+
+        source_tags = f._feature.tags
+        tags = []
+        for i in range(0, len(source_tags) - 1, 2):
+            k, v = source_tags[i], source_tags[i + 1]
+            key = keys[k]
+            if key is None:
+                key = keys[k] = self._key(source_layer.keys[k])
+            if key in added_keys:
+                continue
+            value = values[v]
+            if value is None:
+                value = values[v] = self._value(source_layer.values[v])
+            tags += [key, value]
+
+        for key, value in zip(added_keys, attributes.values()):
+            tags += [key, self._int_value(value)]
+
+        feature = self._layer.features.add()
+        feature.CopyFrom(f._feature)
+        feature.tags[:] = tags
+        if not f._feature.HasField("id"):
+            feature.id = random.randrange(2 ** 32)
+
+
+def build_tile(
+    full: Optional[LazyTile],
+    layer_features: Dict[str, List[object]],
+    layer_attributes: Optional[Dict[str, Dict[str, List[int]]]] = None,
+) -> bytes:
+    """
+    Build the merged layers, the other layers of the full tile are copied
+    byte for byte. Layer attributes are added to the features, by index.
+    """
+    with stage("build"):
+        model = vector_tile_base.VectorTile()
+        for layer_name, features in layer_features.items():
+            layer = LayerBuilder(model.add_layer(layer_name))
+            attributes = (layer_attributes and layer_attributes.get(layer_name)) or {}
+            for i, feature in enumerate(features):
+                layer.add_feature(
+                    feature, {key: values[i] for key, values in attributes.items()}
+                )
+
+    with stage("serialize"):
+        return (
+            b"".join(
+                raw
+                for name, raw in (full.layers if full else [])
+                if name not in layer_features
+            )
+            + model.serialize()
+        )
 
 
-def build_tile(model, layer_features: Dict[str, List[object]]):
-    disabled_layers = layer_features.keys()
-    for layer in model.layers:
-        if layer.name in disabled_layers:
-            layer.name = "_" + layer.name
-            break
+def select_layer_features(
+    cache: Optional[LRUCache],
+    cache_key: Tuple,
+    tile: LazyTile,
+    layer_name: str,
+    select: Callable[[List[object]], List[object]],
+) -> Tuple[List[object], bool]:
+    """
+    Select features from a tile layer. Also returns whether all the features
+    were kept. Results are cached per tile content and layer, so hot tiles are
+    neither decoded nor filtered again.
+    """
+    if cache is not None:
+        cache_key = cache_key + (layer_name, tile.digest)
+        selected = cache.get(cache_key)
+        if selected is not None:
+            return selected
+
+    with stage("decode"):
+        tile_layer = tile.decoded_layer(layer_name)
+    if tile_layer:
+        features = select(tile_layer.features)
+        selected = (features, len(features) == len(tile_layer.features))
+    else:
+        selected = ([], True)
+
+    if cache is not None:
+        # Cached features keep the whole decoded layer alive
+        cache.set(cache_key, selected, max(len(tile.raw_layer(layer_name) or b""), 1))
+
+    return selected
+
+
+def layer_selectors(
+    layer_config, points_in_poly: Optional[Callable[[np.ndarray], np.ndarray]]
+) -> Tuple[Selector, Selector]:
+    """
+    Features to keep from the lower precedence sources, and to add from the
+    merged source.
+    """
+    if layer_config.fields:
+        return (
+            functools.partial(
+                exclude_features,
+                layer_config.fields,
+                classes=layer_config.classes,
+                points_in_poly=points_in_poly,
+            ),
+            functools.partial(
+                include_features,
+                layer_config.fields,
+                classes=layer_config.classes,
+                points_in_poly=points_in_poly,
+            ),
+        )
+    else:
+        return all_features, all_features
 
-    for layer_name, features in layer_features.items():
-        layer = model.add_layer(layer_name)
-        for feature in features:
-            build_feature(layer, feature)
 
-    return model
+def excludes_features(layers: List[Dict[str, Any]]) -> bool:
+    """
+    Whether the merge removes features of the full tile, by their classes.
+    """
+    return any(
+        layer_config.fields and layer_config.classes
+        for partial_layers in layers
+        for layer_config in partial_layers.values()
+    )
 
 
-def merge_tile(
+async def merge_tile(
     min_zoom,
     full,
-    partial,
-    layers,
+    partials: List[Any],
+    layers: List[Dict[str, Any]],
     z: int,
     x: int,
     y: int,
     headers,
     url_params: str,
     tile_in_poly: Optional[TileInPoly],
-):
-    full_tile, full_raw_tile = full.tile(
-        z=z, x=x, y=y, headers=headers, url_params=url_params
-    )
-    if z < min_zoom:
-        return full_raw_tile
-
-    if tile_in_poly and tile_in_poly.is_tile_outside_poly(z, x, y):
-        return full_raw_tile
+    feature_cache: Optional[LRUCache] = None,
+    executor: Optional[Callable[..., Awaitable[Optional[LazyTile]]]] = None,
+    degrade_partials: bool = False,
+    coverage: Optional[int] = None,
+) -> Optional[LazyTile]:
+    """
+    Merge a tile from a full source and partial sources, each one with its
+    merge layers. On each layer, partial sources are merged by increasing
+    precedence, removing the features of their classes and adding their own.
+
+    Source tiles not changed by the merge are returned as is, still
+    compressed. The etag of a merged tile is made from the source ones.
+
+    The pass-through cases are answered inline, the decode and merge of the
+    other tiles run on the executor when set, eg. MergeExecutor.merge().
+
+    A partial source answering 404 has no tile there. With degrade_partials,
+    the full tile is returned as is, flagged degraded, when a partial source
+    fails. The coverage of the tile by the polygon may be given, computed with
+    the ones of other tiles.
+    """
+    if coverage is None and tile_in_poly:
+        coverage = tile_in_poly.tile_coverage(z, x, y)
+
+    if z < min_zoom or coverage == OUTSIDE:
+        with stage("full_fetch"):
+            full_data = await full.tile(
+                z=z, x=x, y=y, headers=headers, url_params=url_params
+            )
+        count_tile(z, "passthrough" if full_data else "empty")
+        return full_data
 
-    if tile_in_poly and tile_in_poly.is_tile_inside_poly(z, x, y):
+    if coverage == INSIDE:
         tile_in_poly = None  # Disable geo filter
 
-    partial_tile, partial_raw_tile = partial.tile(
-        z=z, x=x, y=y, headers=headers, url_params=url_params
+    # Partial sources known to have no tile there are not queried
+    present = [partial.may_have_tile(z, x, y) for partial in partials]
+    if not any(present) and not excludes_features(layers):
+        with stage("full_fetch"):
+            full_data = await full.tile(
+                z=z, x=x, y=y, headers=headers, url_params=url_params
+            )
+        count_tile(z, "passthrough" if full_data else "empty")
+        return full_data
+
+    # Fetch all the tiles at the same time, the partial ones are not needed if
+    # the full one can not be fetched.
+    async def partial_fetch(partial, present: bool):
+        if not present:
+            return None
+        with stage("partial_fetch"):
+            try:
+                return await partial.tile(
+                    z=z, x=x, y=y, headers=headers, url_params=url_params
+                )
+            except httpx.HTTPStatusError as error:
+                # The partial source has no data there
+                if error.response.status_code == 404:
+                    return None
+                raise
+
+    partial_fetches = asyncio.gather(
+        *[partial_fetch(partial, p) for partial, p in zip(partials, present)],
+        return_exceptions=degrade_partials,
+    )
+    try:
+        with stage("full_fetch"):
+            full_data = await full.tile(
+                z=z, x=x, y=y, headers=headers, url_params=url_params
+            )
+    except BaseException:
+        partial_fetches.cancel()
+        raise
+    results = await partial_fetches
+
+    errors = [error for error in results if isinstance(error, BaseException)]
+    if errors:
+        if full_data is None or not all(
+            isinstance(error, (httpx.HTTPError, CircuitOpenError)) for error in errors
+        ):
+            raise errors[0]
+        logger.warning(f"Partial source failure, degraded {z}/{x}/{y}: {errors[0]}")
+        full_data.degraded = True
+        count_tile(z, "degraded")
+        return full_data
+    partial_datas: List[Optional[LazyTile]] = [
+        result for result in results if not isinstance(result, BaseException)
+    ]
+
+    if all(
+        partial_data is None for partial_data in partial_datas
+    ) and not excludes_features(layers):
+        # Nothing to add and nothing to remove, no need to decode the full tile
+        count_tile(z, "passthrough" if full_data else "empty")
+        return full_data
+
+    if full_data is None:
+        partial_tiles = [partial_data for partial_data in partial_datas if partial_data]
+        if len(partial_tiles) <= 1:
+            count_tile(z, "passthrough" if partial_tiles else "empty")
+            return partial_tiles[0] if partial_tiles else None
+
+    cache_keys = [(source, url_params, z, x, y) for source in [full] + list(partials)]
+    if executor is not None:
+        return await executor(
+            full_data,
+            partial_datas,
+            layers,
+            z,
+            x,
+            y,
+            tile_in_poly,
+            feature_cache,
+            cache_keys,
+            url_params,
+        )
+    return merge_tile_data(
+        full_data,
+        partial_datas,
+        layers,
+        z,
+        x,
+        y,
+        tile_in_poly,
+        feature_cache,
+        cache_keys,
     )
 
-    full_features = {}
-    full_features_same = {}
-    partial_features = {}
-    for layer, layer_config in layers.items():
-        if full_tile:
-            full_tile_layer = layer_extract(full_tile, layer)
-            if full_tile_layer:
-                if layer_config.fields:
-                    full_features[layer] = exclude_features(
-                        layer_config.fields,
-                        full_tile_layer.features,
-                        layer_config.classes,
-                        tile_in_poly and tile_in_poly.point_in_poly(z, x, y),
-                    )
-                    full_features_same[layer] = len(full_features[layer]) == len(
-                        full_tile_layer.features
-                    )
-                else:
-                    full_features[layer] = full_tile_layer.features
-                    full_features_same[layer] = True
-            else:
-                full_features[layer] = []
-
-        if partial_tile:
-            partial_tile_layer = layer_extract(partial_tile, layer)
-            if partial_tile_layer:
-                if layer_config.fields:
-                    partial_features[layer] = include_features(
-                        layer_config.fields,
-                        partial_tile_layer.features,
-                        layer_config.classes,
-                        tile_in_poly and tile_in_poly.point_in_poly(z, x, y),
-                    )
-                else:
-                    partial_features[layer] = partial_tile_layer.features
-            else:
-                partial_features[layer] = []
 
-    if len(list(filter(lambda f: f, partial_features))) == 0:
-        if full_tile is None:
-            return None
-        elif len(full_features) == 0:
-            return full_raw_tile
-        elif all(full_features_same.values()):
-            return full_raw_tile
+async def merge_tiles(
+    min_zoom,
+    full,
+    partials: List[Any],
+    layers: List[Dict[str, Any]],
+    z: int,
+    tiles: Iterable[Tuple[int, int]],
+    headers,
+    url_params: str,
+    tile_in_poly: Optional[TileInPoly],
+    **kwargs,
+) -> Dict[Tuple[int, int], Optional[LazyTile]]:
+    """
+    Merge a block of tiles of a zoom level, eg. a metatile. The MBTiles
+    source tiles are read in one query, the other ones fetched concurrently,
+    and the polygon coverage of the tiles computed at once. Other arguments
+    are the ones of merge_tile().
+    """
+    tiles = list(tiles)
+    coverages = tile_in_poly.tiles_coverage(z, tiles) if tile_in_poly else {}
+    # Partial tiles are not needed out of the merge
+    merged = [
+        tile for tile in tiles if z >= min_zoom and coverages.get(tile) != OUTSIDE
+    ]
+
+    async def prefetch(source, tiles):
+        if isinstance(source, SourceMBTiles):
+            tiles = [(x, y) for x, y in tiles if source.may_have_tile(z, x, y)]
+            return SourcePrefetched(
+                source, await source.tiles(z, tiles) if tiles else {}
+            )
         else:
-            merge_features = build_tile(full_tile, full_features)
-            return merge_features.serialize()
+            return source
 
-    else:
-        if full_tile is None:
-            return partial_raw_tile
-        else:
-            features = {}
-            for layer in set(
-                list(full_features.keys()) + list(partial_features.keys())
-            ):
-                if len(full_features.get(layer, [])) > 0:
-                    features[layer] = rank(
-                        full_features[layer] + partial_features[layer]
-                    )
-                else:
-                    features[layer] = partial_features[layer]
+    sources = await asyncio.gather(
+        prefetch(full, tiles), *[prefetch(partial, merged) for partial in partials]
+    )
+
+    async def merge(x: int, y: int):
+        return await merge_tile(
+            min_zoom,
+            sources[0],
+            sources[1:],
+            layers,
+            z,
+            x,
+            y,
+            headers,
+            url_params,
+            tile_in_poly,
+            coverage=coverages.get((x, y)),
+            **kwargs,
+        )
 
-            merge_features = build_tile(full_tile, features)
-            return merge_features.serialize()
+    merged_tiles = await asyncio.gather(*[merge(x, y) for x, y in tiles])
+    return dict(zip(tiles, merged_tiles))
+
+
+def merge_tile_data(
+    full_data: Optional[LazyTile],
+    partial_datas: List[Optional[LazyTile]],
+    layers: List[Dict[str, Any]],
+    z: int,
+    x: int,
+    y: int,
+    tile_in_poly: Optional[TileInPoly],
+    feature_cache: Optional[LRUCache] = None,
+    cache_keys: Optional[List[Tuple]] = None,
+) -> Optional[LazyTile]:
+    """
+    CPU part of merge_tile(), from the fetched source tiles. Does no I/O, so
+    it can run out of the event loop. The feature cache is used only with a
+    cache key for each source tile, full one first.
+    """
+    if cache_keys is None:
+        feature_cache = None
+        cache_keys = [()] * (1 + len(partial_datas))
+
+    points_in_poly = (
+        functools.partial(tile_in_poly.points_in_poly, z, x, y)
+        if tile_in_poly
+        else None
+    )
+
+    layer_merges: Dict[str, List[Tuple[int, Any]]] = defaultdict(list)
+    for i, partial_layers in enumerate(layers):
+        for layer, layer_config in partial_layers.items():
+            layer_merges[layer].append((i, layer_config))
+
+    features: Dict[str, List[object]] = {}
+    attributes: Dict[str, Dict[str, List[int]]] = {}
+    for layer, merges in layer_merges.items():
+        merges.sort(key=lambda merge: merge[1].precedence)
+        # Ranked as configured by the highest precedence source
+        rank_config = merges[-1][1].rank
+        layer_features: List[object] = []
+        same = True
+        full_features = False
+        sources = 0
+        for n, (i, layer_config) in enumerate(merges):
+            exclude, include = layer_selectors(layer_config, points_in_poly)
+            if n == 0:
+                if full_data:
+                    layer_features, same = select_layer_features(
+                        feature_cache,
+                        cache_keys[0],
+                        full_data,
+                        layer,
+                        exclude,
+                    )
+                    full_features = len(layer_features) > 0
+                    sources += full_features
+            else:
+                kept = exclude(layer_features)
+                same = same and len(kept) == len(layer_features)
+                layer_features = kept
+
+            partial_data = partial_datas[i]
+            if partial_data:
+                included, _ = select_layer_features(
+                    feature_cache,
+                    cache_keys[i + 1],
+                    partial_data,
+                    layer,
+                    include,
+                )
+                if included:
+                    layer_features = layer_features + included
+                    same = False
+                    sources += 1
+
+        # With a partial tile, the layer is ranked even if nothing is added,
+        # unless all the features come from a single partial tile.
+        partial_tile = any(partial_datas[i] is not None for i, _ in merges)
+        if partial_tile and layer_features and (full_features or sources > 1):
+            features[layer] = layer_features
+            with stage("rank"):
+                attributes[layer] = {
+                    rank_config.attribute: rank(layer_features, rank_config)
+                }
+        elif not same:
+            features[layer] = layer_features
+
+    if full_data is not None and len(features) == 0:
+        count_tile(z, "passthrough")
+        return full_data
+    else:
+        count_tile(z, "merged")
+        # Single pass build of all the changed layers
+        return LazyTile(
+            build_tile(full_data, features, attributes),
+            etag=make_etag(
+                *[
+                    tile_data.etag if tile_data else None
+                    for tile_data in [full_data] + partial_datas
+                ]
+            ),
+        )
 
 
 def merge_tilejson(
-    public_tile_urls, full, partial, layers: List[str], headers, url_params: str
+    public_tile_urls,
+    full_tilejson,
+    partial_tilejsons: List[Dict[str, Any]],
+    layers: List[Iterable[str]],
+    url_params: str,
 ):
-    full_tilejson = full.tilejson(headers, url_params)
-    partial_tilejson = partial.tilejson(headers, url_params)
-
-    partial_attribution = partial_tilejson.get("attribution", "")
-    full_attribution = full_tilejson.get("attribution", "")
-    attributions = partial_attribution + "," + full_attribution
-    attributions = attributions.replace("/a> <a", "/a>,<a").split(",")
-    attributions = set(
-        [attribution.strip() for attribution in attributions if attribution.strip()]
+    attributions = (
+        ",".join(
+            [
+                partial_tilejson.get("attribution", "")
+                for partial_tilejson in partial_tilejsons
+            ]
+            + [full_tilejson.get("attribution", "")]
+        )
+        .replace("/a> <a", "/a>,<a")
+        .split(",")
+    )
+    attribution = " ".join(
+        set(
+            [attribution.strip() for attribution in attributions if attribution.strip()]
+        )
     )
-    attributions = " ".join(attributions)
 
     tilejson = copy.deepcopy(full_tilejson)
-    tilejson["attribution"] = attributions
+    tilejson["attribution"] = attribution
 
     if public_tile_urls:
         tilejson["tiles"] = public_tile_urls
@@ -260,21 +674,23 @@ def merge_tilejson(
     if url_params:
         tilejson["tiles"] = [url + f"?{url_params}" for url in public_tile_urls]
 
-    for layer in layers:
-        if "vector_layers" in full_tilejson and not any(
-            filter(
-                lambda l: l["id"] == layer,  # type: ignore
-                full_tilejson["vector_layers"],  # type: ignore
-            )
-        ):
-            if "vector_layers" in partial_tilejson:
-                partial_layer = next(
-                    filter(
-                        lambda l: l["id"] == layer, partial_tilejson["vector_layers"]
-                    )
+    for partial_tilejson, partial_layers in zip(partial_tilejsons, layers):
+        for layer in partial_layers:
+            if "vector_layers" in full_tilejson and not any(
+                filter(
+                    lambda l: l["id"] == layer,  # type: ignore
+                    tilejson["vector_layers"],  # type: ignore
                 )
-                tilejson["vector_layers"].append(partial_layer)
-            else:
-                tilejson["vector_layers"].append({"id": layer})
+            ):
+                if "vector_layers" in partial_tilejson:
+                    partial_layer = next(
+                        filter(
+                            lambda l: l["id"] == layer,
+                            partial_tilejson["vector_layers"],
+                        )
+                    )
+                    tilejson["vector_layers"].append(partial_layer)
+                else:
+                    tilejson["vector_layers"].append({"id": layer})
 
     return tilejson
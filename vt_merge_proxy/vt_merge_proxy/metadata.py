@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Set, Tuple
+
+from .metrics import count_metadata_cache, observe_metadata_cache_age
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache:
+    """
+    Cache of upstream documents, TileJSON and style.json. Entries older than
+    ttl are served stale while fetched again in background. The last good copy
+    is kept when upstream fails.
+
+    Lookups are counted by result, also exported as Prometheus metrics with
+    the age of the oldest entry.
+    """
+
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.errors = 0
+        self._entries: Dict[Hashable, Tuple[Any, float]] = {}
+        self._fetches = SingleFlight()
+        self._refreshing: Set[Hashable] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ages(self) -> Dict[Hashable, float]:
+        """
+        Seconds since the last successful fetch of each entry.
+        """
+        now = time.monotonic()
+        return {key: now - fetched_at for key, (_, fetched_at) in self._entries.items()}
+
+    async def get(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            count_metadata_cache("miss")
+            return await self._fetches.do(key, lambda: self._fetch(key, fetch))
+
+        value, fetched_at = entry
+        if fetched_at + self.ttl < time.monotonic():
+            self.stale += 1
+            count_metadata_cache("stale")
+            self.refresh(key, fetch)
+        else:
+            self.hits += 1
+            count_metadata_cache("hit")
+        observe_metadata_cache_age(max(self.ages().values()))
+        return value
+
+    async def _fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]):
+        value = await fetch()
+        self._entries[key] = (value, time.monotonic())
+        return value
+
+    def refresh(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]):
+        """
+        Fetch the entry in background.
+        """
+        if key in self._refreshing:
+            return
+
+        async def refresh():
+            try:
+                await self._fetches.do(key, lambda: self._fetch(key, fetch))
+            except Exception:
+                self.errors += 1
+                count_metadata_cache("error")
+                logger.exception(f"Fails to refresh {key}, keep the last copy")
+            finally:
+                self._refreshing.discard(key)
+
+        self._refreshing.add(key)
+        task = asyncio.ensure_future(refresh())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
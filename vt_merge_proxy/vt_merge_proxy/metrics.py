@@ -0,0 +1,189 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Host and data_id of the tile being served, set by the request handler and
+# inherited by the tasks it starts.
+tile_labels: contextvars.ContextVar[Tuple[str, str]] = contextvars.ContextVar(
+    "tile_labels", default=("", "")
+)
+
+# Observations of the merges made in a worker process, recorded instead of
+# observed to be sent back and replayed in the server process.
+Records = List[Tuple[str, Tuple[Any, ...]]]
+_records: contextvars.ContextVar[Optional[Records]] = contextvars.ContextVar(
+    "records", default=None
+)
+
+STAGE_SECONDS = Histogram(
+    "vt_merge_stage_seconds",
+    "Time spent in each stage of the tiles merge",
+    ["host", "data_id", "stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+UPSTREAM_SECONDS = Histogram(
+    "vt_merge_upstream_seconds",
+    "Latency of the upstream tile fetches, by response status",
+    ["upstream", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+UPSTREAM_SKIPPED = Counter(
+    "vt_merge_upstream_skipped",
+    "Upstream tile fetches not made: negative cache hit or open circuit",
+    ["upstream", "reason"],
+)
+
+UPSTREAM_RETRIES = Counter(
+    "vt_merge_upstream_retries",
+    "Additional upstream tile fetches: retry after an error or hedge on a mirror",
+    ["upstream", "kind"],
+)
+
+METADATA_CACHE = Counter(
+    "vt_merge_metadata_cache",
+    "Lookups of the TileJSON and style.json cache, by result: hit, miss, stale"
+    " or refresh error",
+    ["result"],
+)
+
+METADATA_CACHE_AGE = Gauge(
+    "vt_merge_metadata_cache_age_seconds",
+    "Seconds since the last successful fetch of the oldest cached document",
+    multiprocess_mode="max",
+)
+
+CACHE_LOOKUPS = Counter(
+    "vt_merge_cache_lookups",
+    "Lookups of the in memory caches, eg. the feature cache, by result: hit or"
+    " miss",
+    ["cache", "result"],
+)
+
+TILES = Counter(
+    "vt_merge_tiles",
+    "Tiles merged, by result: passthrough of a source tile, merged, empty or"
+    " degraded to the full tile",
+    ["host", "data_id", "zoom", "result"],
+)
+
+TILE_BYTES = Histogram(
+    "vt_merge_tile_bytes",
+    "Size of the tiles sent, as encoded",
+    ["host", "data_id"],
+    buckets=(1 << 10, 4 << 10, 16 << 10, 64 << 10, 128 << 10, 256 << 10, 512 << 10),
+)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+@contextmanager
+def recording() -> Iterator[Records]:
+    records: Records = []
+    token = _records.set(records)
+    try:
+        yield records
+    finally:
+        _records.reset(token)
+
+
+def _record(kind: str, *args) -> bool:
+    records = _records.get()
+    if records is None:
+        return False
+    records.append((kind, args))
+    return True
+
+
+def replay(records: Records):
+    """
+    Observe the records of a worker process, with the current tile labels.
+    """
+    for kind, args in records:
+        _replayed[kind](*args)
+
+
+def observe_stage(name: str, seconds: float):
+    if _record("stage", name, seconds):
+        return
+    host, data_id = tile_labels.get()
+    STAGE_SECONDS.labels(host, data_id, name).observe(seconds)
+
+
+def count_tile(z: int, result: str):
+    if _record("tile", z, result):
+        return
+    host, data_id = tile_labels.get()
+    TILES.labels(host, data_id, str(z), result).inc()
+
+
+def observe_tile_size(size: int):
+    host, data_id = tile_labels.get()
+    TILE_BYTES.labels(host, data_id).observe(size)
+
+
+def observe_upstream(upstream: str, status: str, seconds: float):
+    UPSTREAM_SECONDS.labels(upstream, status).observe(seconds)
+
+
+def count_upstream_skipped(upstream: str, reason: str):
+    UPSTREAM_SKIPPED.labels(upstream, reason).inc()
+
+
+def count_upstream_retry(upstream: str, kind: str):
+    UPSTREAM_RETRIES.labels(upstream, kind).inc()
+
+
+def count_cache_lookup(cache: str, result: str):
+    if _record("cache", cache, result):
+        return
+    CACHE_LOOKUPS.labels(cache, result).inc()
+
+
+def count_metadata_cache(result: str):
+    METADATA_CACHE.labels(result).inc()
+
+
+def observe_metadata_cache_age(seconds: float):
+    METADATA_CACHE_AGE.set(seconds)
+
+
+_replayed: Dict[str, Callable[..., None]] = {
+    "stage": observe_stage,
+    "tile": count_tile,
+    "cache": count_cache_lookup,
+}
+
+
+def latest() -> bytes:
+    """
+    Metrics in the Prometheus text format. When PROMETHEUS_MULTIPROC_DIR is
+    set, eg. to run with many uvicorn workers, the metrics of all the worker
+    processes are aggregated.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    else:
+        return generate_latest(REGISTRY)
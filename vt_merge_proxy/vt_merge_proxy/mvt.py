@@ -0,0 +1,74 @@
+"""
+Minimal reader of the vector tile protobuf wire format. It splits tiles into
+raw layers, to copy them byte for byte without decoding.
+"""
+from typing import List, Optional, Tuple
+
+WIRE_VARINT = 0
+WIRE_64BIT = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_32BIT = 5
+
+TILE_LAYERS = 3
+LAYER_NAME = 1
+
+
+def read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def read_field(data: bytes, pos: int) -> Tuple[int, int, int, int]:
+    """
+    Read a field, returns its number, wire type and the bounds of its value.
+    """
+    key, pos = read_varint(data, pos)
+    field, wire_type = key >> 3, key & 0x7
+    if wire_type == WIRE_VARINT:
+        _, end = read_varint(data, pos)
+    elif wire_type == WIRE_64BIT:
+        end = pos + 8
+    elif wire_type == WIRE_LENGTH_DELIMITED:
+        length, pos = read_varint(data, pos)
+        end = pos + length
+    elif wire_type == WIRE_32BIT:
+        end = pos + 4
+    else:
+        raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+
+    if end > len(data):
+        raise ValueError("Truncated protobuf message")
+    return field, wire_type, pos, end
+
+
+def layer_name(layer: bytes) -> Optional[str]:
+    pos = 0
+    while pos < len(layer):
+        field, wire_type, start, pos = read_field(layer, pos)
+        if field == LAYER_NAME and wire_type == WIRE_LENGTH_DELIMITED:
+            return layer[start:pos].decode("utf-8")
+    return None
+
+
+def split_layers(tile: bytes) -> List[Tuple[Optional[str], bytes]]:
+    """
+    Split a tile into its layers names and raw fields, key included. Any
+    concatenation of raw fields is a valid tile.
+    """
+    layers = []
+    pos = 0
+    while pos < len(tile):
+        field_pos = pos
+        field, wire_type, start, pos = read_field(tile, pos)
+        if field == TILE_LAYERS and wire_type == WIRE_LENGTH_DELIMITED:
+            layers.append((layer_name(tile[start:pos]), tile[field_pos:pos]))
+        else:
+            layers.append((None, tile[field_pos:pos]))
+    return layers
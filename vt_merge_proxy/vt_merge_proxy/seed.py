@@ -0,0 +1,298 @@
+"""
+Pre-seed the merged tiles of a config source, into an MBTiles or a z/x/y
+directory of gzipped tiles.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from .compression import compression_level, configure_compression
+from .config import MergeConfig, load_config, merge_config_factory
+from .mbtiles import MBTilesWriter
+from .merge import merge_tilejson, merge_tiles
+from .sources import close_http_clients, configure_http_client, configure_upstream
+
+BBox = Tuple[float, float, float, float]
+SeededTiles = List[Tuple[int, int, bytes]]
+
+
+def bbox_tiles(z: int, bbox: BBox) -> Iterator[Tuple[int, int]]:
+    """
+    Tiles of a zoom level covering a lon/lat bbox.
+    """
+    lon_min, lat_min, lon_max, lat_max = bbox
+    n = 2 ** z
+
+    def tile(lon, lat):
+        lat = max(min(lat, 85.0511), -85.0511)
+        x = int((lon + 180) / 360 * n)
+        y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+        return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+    x_min, y_min = tile(lon_min, lat_max)
+    x_max, y_max = tile(lon_max, lat_min)
+    for x in range(x_min, x_max + 1):
+        for y in range(y_min, y_max + 1):
+            yield (x, y)
+
+
+def blocks(
+    tiles: Iterable[Tuple[int, int]], block_size: int
+) -> List[List[Tuple[int, int]]]:
+    """
+    Group the tiles by square blocks, read at once from MBTiles sources.
+    """
+    grouped: Dict[Tuple[int, int], List[Tuple[int, int]]] = defaultdict(list)
+    for x, y in tiles:
+        grouped[(x // block_size, y // block_size)].append((x, y))
+    return [grouped[block] for block in sorted(grouped)]
+
+
+async def seed_block(
+    mc: MergeConfig, z: int, tiles: List[Tuple[int, int]]
+) -> SeededTiles:
+    merged = await merge_tiles(
+        mc.min_zoom,
+        mc.sources[0],
+        mc.sources[1:],
+        mc.layers,
+        z,
+        tiles,
+        headers={},
+        url_params="",
+        tile_in_poly=mc.tile_in_poly,
+    )
+    return [
+        (x, y, tile.encode("gzip", compression_level("gzip")))
+        for (x, y), tile in merged.items()
+        if tile
+    ]
+
+
+# State of the worker processes
+_worker: Dict[str, Any] = {}
+
+
+def configure(config):
+    """
+    Same upstream, HTTP client and compression settings as the server.
+    """
+    configure_http_client(**(config["server"].get("http_client") or {}))
+    configure_upstream(**(config["server"].get("upstream") or {}))
+    configure_compression(**(config["server"].get("compression") or {}))
+
+
+def _init_worker(config_path: str, source_id: str):
+    config = load_config(config_path)
+    configure(config)
+    _worker["merge_config"] = merge_config_factory(config["sources"][source_id])
+    # Kept for the process life, the HTTP clients are bound to it
+    _worker["loop"] = asyncio.new_event_loop()
+
+
+def _seed_block(z: int, tiles: List[Tuple[int, int]]) -> Tuple[int, SeededTiles]:
+    return z, _worker["loop"].run_until_complete(
+        seed_block(_worker["merge_config"], z, tiles)
+    )
+
+
+def _write_done(writer, progress: "Progress", done: Dict[Any, int]):
+    for future, count in done.items():
+        z, seeded = future.result()
+        writer.write_tiles(z, seeded)
+        progress.update(count)
+
+
+class DirectoryWriter:
+    """
+    Write tiles as z/x/y.pbf files, with a metadata.json.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def existing_tiles(self, z: int) -> Set[Tuple[int, int]]:
+        existing = set()
+        z_path = os.path.join(self.path, str(z))
+        if os.path.isdir(z_path):
+            for x in os.listdir(z_path):
+                for file in os.listdir(os.path.join(z_path, x)):
+                    if file.endswith(".pbf"):
+                        existing.add((int(x), int(file[: -len(".pbf")])))
+        return existing
+
+    def write_tiles(self, z: int, tiles: Iterable[Tuple[int, int, bytes]]):
+        for x, y, tile_data in tiles:
+            x_path = os.path.join(self.path, str(z), str(x))
+            os.makedirs(x_path, exist_ok=True)
+            # Complete files only, for resuming
+            path = os.path.join(x_path, f"{y}.pbf")
+            with open(path + ".tmp", "wb") as f:
+                f.write(tile_data)
+            os.replace(path + ".tmp", path)
+
+    def write_metadata(self, metadata: Dict[str, str]):
+        with open(os.path.join(self.path, "metadata.json"), "w") as f:
+            json.dump(metadata, f)
+
+    def close(self):
+        pass
+
+
+class Progress:
+    def __init__(self, total: int, interval: float = 10):
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self.start = self.last = time.monotonic()
+
+    def update(self, count: int, force: bool = False):
+        self.done += count
+        now = time.monotonic()
+        if force or now - self.last >= self.interval:
+            self.last = now
+            rate = self.done / max(now - self.start, 1e-9)
+            eta = (self.total - self.done) / rate if rate else 0
+            print(
+                f"{self.done}/{self.total} tiles, {rate:.0f} tiles/s, ETA {eta:.0f}s",
+                file=sys.stderr,
+            )
+
+
+async def merged_metadata(mc: MergeConfig) -> Dict[str, Any]:
+    try:
+        return merge_tilejson(
+            [],
+            await mc.sources[0].tilejson({}, ""),
+            [await source.tilejson({}, "") for source in mc.sources[1:]],
+            [list(partial_layers.keys()) for partial_layers in mc.layers],
+            url_params="",
+        )
+    finally:
+        # The HTTP clients are bound to the event loop, closed after
+        await close_http_clients()
+
+
+def seed(
+    config_path: str,
+    source_id: str,
+    output: str,
+    min_zoom: int,
+    max_zoom: int,
+    bbox: Optional[BBox] = None,
+    processes: Optional[int] = None,
+    block_size: int = 16,
+    progress_interval: float = 10,
+):
+    """
+    Merge all the tiles of a zoom range covering the bbox, or else the source
+    polygon. Tiles already in the output are skipped, to resume a seeding.
+    """
+    config = load_config(config_path)
+    configure(config)
+    mc = merge_config_factory(config["sources"][source_id])
+    tile_in_poly = mc.tile_in_poly
+    if not bbox and not tile_in_poly:
+        raise ValueError("A bbox is required for a source without polygon")
+
+    writer: Union[MBTilesWriter, DirectoryWriter]
+    if output.endswith(".mbtiles"):
+        writer = MBTilesWriter(output)
+    else:
+        writer = DirectoryWriter(output)
+
+    tilejson = asyncio.run(merged_metadata(mc))
+    metadata = {
+        "name": source_id,
+        "format": "pbf",
+        "minzoom": str(min_zoom),
+        "maxzoom": str(max_zoom),
+    }
+    if tilejson.get("attribution"):
+        metadata["attribution"] = tilejson["attribution"]
+    bounds = bbox or tilejson.get("bounds")
+    if isinstance(bounds, str):
+        metadata["bounds"] = bounds
+    elif bounds:
+        metadata["bounds"] = ",".join(map(str, bounds))
+    if tilejson.get("vector_layers"):
+        metadata["json"] = json.dumps({"vector_layers": tilejson["vector_layers"]})
+    elif tilejson.get("json"):
+        metadata["json"] = tilejson["json"]
+    writer.write_metadata(metadata)
+
+    todo = []
+    for z in range(min_zoom, max_zoom + 1):
+        if bbox:
+            tiles = bbox_tiles(z, bbox)
+        elif tile_in_poly:
+            tiles = tile_in_poly.tiles(z)
+        existing = writer.existing_tiles(z)
+        todo += [(z, block) for block in blocks(set(tiles) - existing, block_size)]
+
+    progress = Progress(sum(len(block) for _, block in todo), progress_interval)
+    with ProcessPoolExecutor(
+        processes, initializer=_init_worker, initargs=(config_path, source_id)
+    ) as executor:
+        # Bounded number of blocks in flight, written as they are done
+        max_pending = 2 * (processes or os.cpu_count() or 1)
+        pending: Dict[Any, int] = {}
+        for z, block in todo:
+            pending[executor.submit(_seed_block, z, block)] = len(block)
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                _write_done(writer, progress, {f: pending.pop(f) for f in done})
+        _write_done(writer, progress, pending)
+    progress.update(0, force=True)
+    writer.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--config", default=os.environ.get("CONFIG", "config.yaml"), help="Config file"
+    )
+    parser.add_argument("--source", required=True, help="Source id in the config")
+    parser.add_argument(
+        "--output", required=True, help="Output .mbtiles file or z/x/y directory"
+    )
+    parser.add_argument("--min-zoom", type=int, help="Default to source min_zoom")
+    parser.add_argument("--max-zoom", type=int, required=True)
+    parser.add_argument(
+        "--bbox",
+        type=lambda s: tuple(map(float, s.split(","))),
+        help="lon_min,lat_min,lon_max,lat_max, default to the source polygon",
+    )
+    parser.add_argument("--processes", type=int, help="Default to the CPU count")
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--progress-interval", type=float, default=10)
+    args = parser.parse_args(argv)
+
+    min_zoom = args.min_zoom
+    if min_zoom is None:
+        config = load_config(args.config)
+        min_zoom = int(config["sources"][args.source]["output"]["min_zoom"])
+
+    seed(
+        args.config,
+        args.source,
+        args.output,
+        min_zoom,
+        args.max_zoom,
+        bbox=args.bbox,
+        processes=args.processes,
+        block_size=args.block_size,
+        progress_interval=args.progress_interval,
+    )
+
+
+if __name__ == "__main__":
+    main()
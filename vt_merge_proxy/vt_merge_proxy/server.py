@@ -1,33 +1,89 @@
-import json
+import asyncio
+import functools
+import io
 import os
+import tarfile
 from collections import defaultdict
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlencode
 
-import requests
-import yaml
+import httpx
 from fastapi import FastAPI, Header, HTTPException, Request, Response
-from starlette.responses import RedirectResponse
-
-from .merge import merge_tile, merge_tilejson
-from .sources import Source, sourceFactory
+from prometheus_client import CONTENT_TYPE_LATEST
+from starlette.responses import JSONResponse, RedirectResponse
+
+from .cache import LRUCache
+from .circuit import CircuitOpenError
+from .compression import (
+    accepted_encodings,
+    compression_config,
+    compression_level,
+    configure_compression,
+)
+from .config import MergeConfig, load_config, merge_config_factory
+from .etag import etag_matches, make_etag
+from .executor import feature_cache_factory, merge_executor_factory
+from .merge import merge_tile, merge_tilejson, merge_tiles
+from .metadata import MetadataCache
+from .metrics import latest, observe_tile_size, tile_labels
+from .singleflight import SingleFlight
+from .sources import (
+    LazyTile,
+    Source,
+    close_http_clients,
+    configure_http_client,
+    configure_upstream,
+    fetch_json,
+    set_deadline,
+    upstream_config,
+)
+from .store import TileStore
 from .style import StyleGL
-from .tile_in_poly import TileInPoly
 
 app = FastAPI()
 
 
-config = yaml.load(
-    open(os.environ.get("CONFIG", "config.yaml")).read(), Loader=yaml.UnsafeLoader
-)
+config_path = os.environ.get("CONFIG", "config.yaml")
+config = load_config(config_path)
 print(config)
 
-if not config.get("server"):
-    config["server"] = {}
-
 public_base_path = config["server"].get("public_base_path") or ""
 public_tile_url_prefixes = config["server"].get("public_tile_url_prefixes", [])
 
+configure_http_client(**(config["server"].get("http_client") or {}))
+configure_upstream(**(config["server"].get("upstream") or {}))
+configure_compression(**(config["server"].get("compression") or {}))
+
+feature_cache = feature_cache_factory(config["server"].get("feature_cache"))
+
+merge_executor = merge_executor_factory(
+    config["server"].get("merge_executor"), config_path
+)
+
+tile_merges = SingleFlight()
+
+# Last ETag sent for each tile, to answer conditional requests without merging
+tile_etags = LRUCache(
+    max_size=int((config["server"].get("tile_etags") or {}).get("max_size", 100000))
+)
+
+metadata_cache = MetadataCache(
+    ttl=float((config["server"].get("metadata_cache") or {}).get("ttl", 300))
+)
+
+# Metatiles are blocks of 4 ** depth tiles
+metatile_max_depth = int((config["server"].get("metatile") or {}).get("max_depth", 3))
+
+tile_store = None
+if config["server"].get("tile_store"):
+    tile_store = TileStore(
+        path=config["server"]["tile_store"]["path"],
+        ttl=config["server"]["tile_store"].get("ttl"),
+        max_size=config["server"]["tile_store"].get("max_size"),
+        max_age=config["server"]["tile_store"].get("max_age"),
+        purge_interval=float(config["server"]["tile_store"].get("purge_interval", 60)),
+    )
+
 
 config_by_host: Dict[str, Dict[str, Any]] = defaultdict(dict)
 for (config_id, config_source) in config["sources"].items():
@@ -44,6 +100,36 @@ for (config_id, config_source) in config["sources"].items():
             }
 
 
+def source_tilejson(source: Source):
+    # Shared by all the requests, so not fetched with the client headers
+    return metadata_cache.get(("tilejson", source), lambda: source.tilejson({}, ""))
+
+
+def upstream_style(url: str):
+    return metadata_cache.get(("style", url), lambda: fetch_json(url))
+
+
+@app.on_event("startup")
+async def startup():
+    for mc_by_id in merge_config.values():
+        for mc in mc_by_id.values():
+            for source in mc.sources:
+                metadata_cache.refresh(
+                    ("tilejson", source), lambda source=source: source.tilejson({}, "")
+                )
+    for style_by_id in style_by_host.values():
+        for config_id_style in style_by_id.values():
+            url = config_id_style["style_config"]["url"]
+            metadata_cache.refresh(("style", url), lambda url=url: fetch_json(url))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_http_clients()
+    if merge_executor:
+        merge_executor.shutdown()
+
+
 @app.get("/")
 async def read_root():
     return RedirectResponse(url="/data.json")
@@ -82,6 +168,11 @@ def public_url(request: Request, host_prefix=""):
         return f"{proto}://{host_prefix}{host}{port}"
 
 
+@app.get("/metrics")
+async def metrics():
+    return Response(content=latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/data.json")
 async def data(request: Request):
     host = public_host(request)
@@ -99,43 +190,60 @@ async def data(request: Request):
     ]
 
 
-@dataclass
-class LayerConfig(object):
-    fields: List[str]
-    classes: List
-
-
-@dataclass
-class MergeConfig(object):
-    sources: List[Source]
-    min_zoom: int
-    tile_in_poly: Optional[TileInPoly]
-    layers: Dict[str, LayerConfig]
-
-
-merge_config: Dict[str, Dict[str, Any]] = defaultdict(dict)
+merge_config: Dict[str, Dict[str, MergeConfig]] = defaultdict(dict)
 for (host, source_id_confs) in config_by_host.items():
     for (source_id, source_conf) in source_id_confs.items():
-        tile_in_poly = None
-        if "polygon" in source_conf:
-            tile_in_poly = TileInPoly(open(source_conf["polygon"]))
-
-        merge_config[host][source_id] = MergeConfig(
-            sources=[
-                sourceFactory(source) for source in source_conf["sources"].values()
-            ],
-            min_zoom=int(source_conf["output"]["min_zoom"]),
-            tile_in_poly=tile_in_poly,
-            layers={
-                layer: LayerConfig(
-                    fields=merge_layer and merge_layer.get("fields"),
-                    classes=merge_layer
-                    and merge_layer.get("classes")
-                    and json.loads(open(merge_layer["classes"], "r").read()),
-                )
-                for layer, merge_layer in source_conf["merge_layers"].items()
-            },
-        )
+        merge_config[host][source_id] = merge_config_factory(source_conf)
+
+
+def tile_etag_header(etag: str, encoding: Optional[str]) -> str:
+    # Each encoding is a different representation, ignored by etag_matches()
+    return f'"{etag}-{encoding}"' if encoding else f'"{etag}"'
+
+
+def response_encoding(
+    tile_encoding: Optional[str], accept_encoding: Optional[str]
+) -> Optional[str]:
+    """
+    Encoding of a tile as sent to the client, also for the ETag of a 304.
+    """
+    encodings = accepted_encodings(accept_encoding)
+    if tile_encoding is None and compression_config["encoding"] in encodings:
+        return compression_config["encoding"]
+    return tile_encoding if tile_encoding in encodings else None
+
+
+def json_response(request: Request, content) -> Response:
+    response = JSONResponse(content)
+    etag = make_etag(bytes(response.body))
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": f'"{etag}"'})
+    response.headers["ETag"] = f'"{etag}"'
+    return response
+
+
+def tile_response(
+    tile: Optional[LazyTile], accept_encoding: Optional[str], etag: Optional[str]
+) -> Response:
+    """
+    Send the tile as is when the client accept its encoding, else compress it
+    with the configured encoding or fallback to the uncompressed tile.
+    """
+    headers = {"Vary": "Accept-Encoding"}
+    if tile is None or etag is None:
+        return Response(media_type="application/vnd.vector-tile", headers=headers)
+
+    encoding = response_encoding(tile.encoding, accept_encoding)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        content = tile.encode(encoding, compression_config["level"])
+    else:
+        content = tile.raw
+    headers["ETag"] = tile_etag_header(etag, encoding)
+    observe_tile_size(len(content or b""))
+    return Response(
+        content=content, media_type="application/vnd.vector-tile", headers=headers
+    )
 
 
 @app.get("/data/{data_id}/{z}/{x}/{y}.pbf")
@@ -146,23 +254,168 @@ async def tile(data_id: str, z: int, x: int, y: int, request: Request):
             raise HTTPException(status_code=404)
 
         mc = merge_config[host][data_id]
-        data = merge_tile(
+        tile_labels.set((host, data_id))
+        set_deadline(upstream_config["deadline"])
+        query = urlencode(sorted(request.query_params.multi_items()))
+        key = (host, data_id, z, x, y, query)
+        if_none_match = request.headers.get("if-none-match")
+        accept_encoding = request.headers.get("accept-encoding")
+        version = mc.version()
+
+        # With only versioned sources, the inputs are known to be unchanged
+        if if_none_match and all(source.version() for source in mc.sources):
+            known = tile_etags.get(key)
+            if known and known[1] == version and etag_matches(if_none_match, known[0]):
+                etag_header = tile_etag_header(
+                    known[0], response_encoding(known[2], accept_encoding)
+                )
+                return Response(
+                    status_code=304,
+                    headers={"ETag": etag_header, "Vary": "Accept-Encoding"},
+                )
+
+        async def merge():
+            return await merge_tile(
+                mc.min_zoom,
+                mc.sources[0],
+                mc.sources[1:],
+                mc.layers,
+                z,
+                x,
+                y,
+                headers=request.headers,
+                url_params=str(request.query_params),
+                tile_in_poly=mc.tile_in_poly,
+                feature_cache=feature_cache,
+                executor=merge_executor
+                and functools.partial(merge_executor.merge, data_id),
+                degrade_partials=mc.degrade_partials,
+            )
+
+        if tile_store:
+            data = await tile_merges.do(
+                key, lambda: tile_store.get((data_id, z, x, y, query), version, merge)
+            )
+        else:
+            data = await tile_merges.do(key, merge)
+
+        etag = make_etag(mc.config_version, data.etag) if data else None
+        if etag and data and not data.degraded:
+            # Degraded tiles are merged again once the partial sources are back
+            tile_etags.set(key, (etag, version, data.encoding), 1)
+        if data and etag and etag_matches(if_none_match, etag):
+            etag_header = tile_etag_header(
+                etag, response_encoding(data.encoding, accept_encoding)
+            )
+            return Response(
+                status_code=304,
+                headers={"ETag": etag_header, "Vary": "Accept-Encoding"},
+            )
+        return tile_response(data, accept_encoding, etag)
+    except CircuitOpenError as error:
+        raise HTTPException(
+            status_code=503,
+            detail=str(error),
+            headers={"Retry-After": str(int(error.retry_after))},
+        )
+    except httpx.TimeoutException as error:
+        raise HTTPException(status_code=504, detail=str(error))
+    except httpx.HTTPStatusError as error:
+        raise HTTPException(
+            status_code=error.response.status_code,
+            detail=error.response.reason_phrase,
+        )
+    except httpx.TransportError as error:
+        raise HTTPException(status_code=502, detail=str(error))
+
+
+def tar_response(
+    z: int, tiles: Dict[Tuple[int, int], Optional[LazyTile]], etag: str
+) -> Response:
+    """
+    Tar of the gzipped z/x/y.pbf tiles, without the empty ones.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for (x, y), tile in sorted(tiles.items()):
+            if tile is None:
+                continue
+            tile_data = tile.encode("gzip", compression_level("gzip"))
+            info = tarfile.TarInfo(f"{z}/{x}/{y}.pbf")
+            info.size = len(tile_data)
+            tar.addfile(info, io.BytesIO(tile_data))
+    return Response(
+        content=buffer.getvalue(),
+        media_type="application/x-tar",
+        headers={"ETag": f'"{etag}"'},
+    )
+
+
+@app.get("/data/{data_id}/{z}/{x}/{y}.tar")
+async def metatile(
+    data_id: str, z: int, x: int, y: int, request: Request, depth: int = 2
+):
+    """
+    Merged tiles of zoom z + depth under the tile z/x/y, in a tar.
+    """
+    host = public_host(request)
+    if host not in config_by_host:
+        raise HTTPException(status_code=404)
+
+    mc = merge_config.get(host) and merge_config[host].get(data_id)
+    if not mc:
+        raise HTTPException(status_code=404)
+    if not 0 <= depth <= metatile_max_depth:
+        raise HTTPException(
+            status_code=400, detail=f"depth must be from 0 to {metatile_max_depth}"
+        )
+
+    tile_labels.set((host, data_id))
+    set_deadline(upstream_config["deadline"])
+    url_params = urlencode(
+        [(k, v) for k, v in request.query_params.multi_items() if k != "depth"]
+    )
+    size = 2 ** depth
+    tiles = [(x * size + dx, y * size + dy) for dx in range(size) for dy in range(size)]
+    try:
+        merged = await merge_tiles(
             mc.min_zoom,
             mc.sources[0],
-            mc.sources[1],
+            mc.sources[1:],
             mc.layers,
-            z,
-            x,
-            y,
+            z + depth,
+            tiles,
             headers=request.headers,
-            url_params=str(request.query_params),
+            url_params=url_params,
             tile_in_poly=mc.tile_in_poly,
+            feature_cache=feature_cache,
+            executor=merge_executor
+            and functools.partial(merge_executor.merge, data_id),
+            degrade_partials=mc.degrade_partials,
+        )
+    except CircuitOpenError as error:
+        raise HTTPException(
+            status_code=503,
+            detail=str(error),
+            headers={"Retry-After": str(int(error.retry_after))},
         )
-        return Response(content=data, media_type="application/vnd.vector-tile")
-    except requests.exceptions.HTTPError as error:
+    except httpx.TimeoutException as error:
+        raise HTTPException(status_code=504, detail=str(error))
+    except httpx.HTTPStatusError as error:
         raise HTTPException(
-            status_code=error.response.status_code, detail=error.response.reason
+            status_code=error.response.status_code,
+            detail=error.response.reason_phrase,
         )
+    except httpx.TransportError as error:
+        raise HTTPException(status_code=502, detail=str(error))
+
+    etag = make_etag(
+        mc.config_version,
+        *[f"{x}/{y}:{tile and tile.etag}" for (x, y), tile in sorted(merged.items())],
+    )
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": f'"{etag}"'})
+    return tar_response(z + depth, merged, etag)
 
 
 @app.get("/data/{data_id}.json")
@@ -185,18 +438,23 @@ async def tilejson(data_id: str, request: Request):
                 for public_tile_url_prefixe in public_tile_url_prefixes
             ]
 
-        return merge_tilejson(
-            data_public_tile_urls,
-            mc.sources[0],
-            mc.sources[1],
-            mc.layers.keys(),
-            headers=request.headers,
-            url_params=str(request.query_params),
+        return json_response(
+            request,
+            merge_tilejson(
+                data_public_tile_urls,
+                await source_tilejson(mc.sources[0]),
+                await asyncio.gather(*map(source_tilejson, mc.sources[1:])),
+                [partial_layers.keys() for partial_layers in mc.layers],
+                url_params=str(request.query_params),
+            ),
         )
-    except requests.exceptions.HTTPError as error:
+    except httpx.HTTPStatusError as error:
         raise HTTPException(
-            status_code=error.response.status_code, detail=error.response.reason
+            status_code=error.response.status_code,
+            detail=error.response.reason_phrase,
         )
+    except httpx.TransportError as error:
+        raise HTTPException(status_code=502, detail=str(error))
 
 
 @app.get("/styles.json")
@@ -230,8 +488,18 @@ async def style(style_id: str, request: Request):
     id = config_id_style["config_id"]
     style_config = config_id_style["style_config"]
 
+    try:
+        gljson = await upstream_style(style_config["url"])
+    except httpx.HTTPStatusError as error:
+        raise HTTPException(
+            status_code=error.response.status_code,
+            detail=error.response.reason_phrase,
+        )
+    except httpx.TransportError as error:
+        raise HTTPException(status_code=502, detail=str(error))
+
     style_gl = StyleGL(
-        url=style_config["url"],
+        gljson,
         overwrite={
             "sources": {
                 style_config["merged_source"]: {
@@ -252,4 +520,4 @@ async def style(style_id: str, request: Request):
         insert_before_id = layer.get("insert_before_id")
         style_gl.insert_layer(layer["layer"], before=insert_before_id)
 
-    return style_gl.json()
+    return json_response(request, style_gl.json())
@@ -1,62 +1,712 @@
-import gzip
+import asyncio
+import contextvars
+import hashlib
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+from urllib.parse import urlsplit
 
-import pymbtiles  # type: ignore
+import httpx
 import requests
 import vector_tile_base  # type: ignore
 
+from .cache import LRUCache
+from .circuit import CircuitBreaker, CircuitOpenError
+from .compression import compress, decompress
+from .etag import make_etag
+from .mbtiles import MBTilesReader
+from .metrics import count_upstream_retry, count_upstream_skipped, observe_upstream
+from .mvt import split_layers
+from .singleflight import SingleFlight
+from .tile_index import TileIndex
+
+logger = logging.getLogger(__name__)
+
+# Headers that must not be forwarded by a proxy (RFC 7230 section 6.1), also
+# rejected by HTTP/2.
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "content-length",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+# Validators of the client are about the merged tiles, not the upstream ones.
+# An upstream 304 would also be an error for the other clients of the fetch.
+CONDITIONAL_HEADERS = {
+    "if-match",
+    "if-modified-since",
+    "if-none-match",
+    "if-range",
+    "if-unmodified-since",
+}
+
+http_client_config: Dict[str, Any] = {
+    "max_connections": 256,
+    "max_keepalive_connections": 64,
+    "keepalive_expiry": 30,
+    "http2": True,
+}
+
+_http_clients: Dict[str, httpx.AsyncClient] = {}
+# The clients of the parent, and their connections, are bound to its event
+# loop and can not be used by a forked worker process.
+os.register_at_fork(after_in_child=_http_clients.clear)
+
+upstream_config: Dict[str, Any] = {
+    # Circuit breaker of each XYZ source
+    "failure_threshold": 5,
+    "reset_timeout": 30,
+    # Slower calls count as failures, disabled if None
+    "slow_call": None,
+    # Negative cache of the missing or empty tiles, and of the errors
+    "negative_ttl": 60,
+    "error_ttl": 5,
+    "negative_cache_size": 100000,
+    # Seconds, of each fetch attempt, and of all the fetches of a tile request
+    "timeout": 10,
+    "deadline": None,
+    # Retries of the 5xx, 429 and transport errors, backoff of the first one
+    "retries": 2,
+    "retry_backoff": 0.05,
+    # Latency percentile after which a fetch is hedged on a mirror
+    "hedge_percentile": 95,
+    "hedge_min_delay": 0.01,
+}
+
+# Monotonic time by which the upstream fetches must be done
+deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "deadline", default=None
+)
+
+
+class DeadlineExceeded(httpx.TimeoutException):
+    """
+    A fetch cut short by the deadline of the tile request. It is not about the
+    upstream health, and not cached for the other requests.
+    """
+
+
+def configure_http_client(**kwargs):
+    http_client_config.update(kwargs)
+
+
+def configure_upstream(**kwargs):
+    upstream_config.update(kwargs)
+
+
+def set_deadline(seconds: Optional[float]):
+    """
+    Set the deadline of the upstream fetches made by the current task and by
+    the tasks it starts.
+    """
+    deadline.set(time.monotonic() + seconds if seconds is not None else None)
+
+
+def remaining() -> Optional[float]:
+    """
+    Seconds left before the deadline, None without deadline.
+    """
+    at = deadline.get()
+    return at - time.monotonic() if at is not None else None
+
+
+def attempt_timeout() -> float:
+    timeout = float(upstream_config["timeout"])
+    left = remaining()
+    if left is not None:
+        if left <= 0:
+            raise DeadlineExceeded("Deadline exceeded")
+        timeout = min(timeout, left)
+    return timeout
+
+
+def is_upstream_failure(error: Exception) -> bool:
+    """
+    Errors worth a retry. Client errors are answers of an healthy upstream.
+    """
+    if isinstance(error, DeadlineExceeded):
+        return False
+    elif isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, httpx.TransportError)
+
+
+def http_client(url: str) -> httpx.AsyncClient:
+    """
+    Shared keep-alive connection pool, one per upstream scheme and host.
+    """
+    split = urlsplit(url)
+    origin = f"{split.scheme}://{split.netloc}"
+    client = _http_clients.get(origin)
+    if not client:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=http_client_config["max_connections"],
+                max_keepalive_connections=http_client_config[
+                    "max_keepalive_connections"
+                ],
+                keepalive_expiry=http_client_config["keepalive_expiry"],
+            ),
+            http2=http_client_config["http2"],
+            timeout=None,
+        )
+        _http_clients[origin] = client
+    return client
+
+
+async def close_http_clients():
+    for client in _http_clients.values():
+        await client.aclose()
+    _http_clients.clear()
+
+
+async def fetch_json(url: str, headers: Optional[Mapping[str, str]] = None):
+    """
+    Fetch a document, eg. a TileJSON, within the upstream timeout.
+    """
+    timeout = float(upstream_config["timeout"])
+    try:
+        r = await asyncio.wait_for(
+            http_client(url).get(url, headers=forward_headers(headers)), timeout
+        )
+    except asyncio.TimeoutError:
+        raise httpx.TimeoutException(f"Timeout after {timeout:.2f}s: {url}")
+    r.raise_for_status()
+    return r.json()
+
+
+def forward_headers(
+    headers: Optional[Mapping[str, str]], drop: Set[str] = set()
+) -> Dict[str, str]:
+    if not headers:
+        return {}
+    return {
+        k: v
+        for k, v in headers.items()
+        if k.lower() not in HOP_BY_HOP_HEADERS
+        and k.lower() not in CONDITIONAL_HEADERS
+        and k.lower() not in drop
+    }
+
+
+class LazyTile:
+    """
+    Vector tile, raw or compressed. It is only decompressed, split and decoded
+    when the merge needs its features. Compressed tiles are kept to be sent as
+    is to the clients.
+
+    The etag identifies the content, it is given by the upstream or computed
+    from the tile data.
+    """
+
+    def __init__(
+        self,
+        raw: Optional[bytes] = None,
+        encoded: Optional[bytes] = None,
+        encoding: Optional[str] = None,
+        etag: Optional[str] = None,
+    ):
+        self._raw = raw
+        self._etag = etag
+        self.encoded = encoded
+        self.encoding = encoding if encoding != "identity" else None
+        if self.encoding is None and raw is None:
+            self._raw = encoded
+        # Served in place of the merged tile, while a partial source is down
+        self.degraded = False
+        self._layers: Optional[List[Tuple[Optional[str], bytes]]] = None
+        self._decoded_layers: Dict[str, Any] = {}
+        self._digest: Optional[bytes] = None
+
+    @classmethod
+    def from_blob(cls, blob: bytes, etag: Optional[str] = None) -> "LazyTile":
+        """
+        Tile stored in MBTiles, usually gzipped. The etag defaults to one made
+        from the blob.
+        """
+        etag = etag or make_etag(blob)
+        if blob[:2] == b"\x1f\x8b":
+            return cls(encoded=blob, encoding="gzip", etag=etag)
+        else:
+            return cls(raw=blob, etag=etag)
+
+    @property
+    def raw(self) -> bytes:
+        if self._raw is None:
+            self._raw = decompress(self.encoded or b"", self.encoding)
+        return self._raw
+
+    def encode(self, encoding: str, level: Optional[int] = None) -> bytes:
+        if self.encoding == encoding and self.encoded is not None:
+            return self.encoded
+
+        encoded = compress(self.raw, encoding, level)
+        if self.encoding is None:
+            self.encoded, self.encoding = encoded, encoding
+        return encoded
+
+    @property
+    def etag(self) -> str:
+        if self._etag is None:
+            self._etag = self.digest.hex()
+        return self._etag
+
+    @property
+    def digest(self) -> bytes:
+        if self._digest is None:
+            self._digest = hashlib.blake2b(self.raw, digest_size=16).digest()
+        return self._digest
+
+    @property
+    def layers(self) -> List[Tuple[Optional[str], bytes]]:
+        """
+        Raw layers, as names and protobuf fields.
+        """
+        if self._layers is None:
+            self._layers = split_layers(self.raw)
+        return self._layers
+
+    def raw_layer(self, layer_name: str) -> Optional[bytes]:
+        return next((raw for name, raw in self.layers if name == layer_name), None)
+
+    def decoded_layer(self, layer_name: str):
+        if layer_name not in self._decoded_layers:
+            raw = self.raw_layer(layer_name)
+            self._decoded_layers[layer_name] = (
+                vector_tile_base.VectorTile(raw).layers[0] if raw else None
+            )
+        return self._decoded_layers[layer_name]
+
 
 class Source:
-    def tilejson(self, headers, url_params: str):
+    async def tile(
+        self, z: int, x: int, y: int, headers, url_params: str
+    ) -> Optional[LazyTile]:
+        raise NotImplementedError()
+
+    def may_have_tile(self, z: int, x: int, y: int) -> bool:
+        """
+        False when the source is known to have no tile there.
+        """
+        return True
+
+    async def tilejson(self, headers, url_params: str):
         return {}
 
+    def version(self) -> Optional[str]:
+        """
+        Identifier of the current content of the source, when it is known.
+        """
+        return None
+
 
 class SourceMBTiles(Source):
-    def __init__(self, mbtiles: str):
-        self.src = pymbtiles.MBtiles(mbtiles)
+    """
+    With index, the tiles present are known without querying the MBTiles.
+    The index is saved in a sidecar file, and built again when the MBTiles
+    is replaced.
+    """
+
+    def __init__(self, mbtiles: str, index: bool = False):
+        self.path = mbtiles
+        self.src = MBTilesReader(mbtiles)
+        self.index: Optional[TileIndex] = None
+        self._indexing = False
+        self._tasks: Set[asyncio.Task] = set()
+        if index:
+            self.index = self.load_index()
+
+    @property
+    def index_path(self) -> str:
+        return f"{self.path}.index.npz"
 
-    def tile(self, z: int, x: int, y: int, headers, url_params: str):
-        y = 2 ** z - 1 - y
+    def load_index(self) -> TileIndex:
+        version = self.src.version()
+        index = TileIndex.load(self.index_path, version)
+        if index is None:
+            index = TileIndex.from_tiles(version, self.src.read_tile_coords())
+            try:
+                index.save(self.index_path)
+            except OSError:
+                logger.warning(f"Fails to save the tile index {self.index_path}")
+        return index
+
+    def may_have_tile(self, z: int, x: int, y: int) -> bool:
+        if self.index is None:
+            return True
+        elif self.index.version != self.src.version():
+            self._reindex()
+            return True
+        else:
+            return (z, x, y) in self.index
+
+    def _reindex(self):
+        if self._indexing:
+            return
+
+        async def reindex():
+            try:
+                self.index = await self.src.run(self.load_index)
+            except Exception:
+                logger.exception(f"Fails to index {self.path}")
+            finally:
+                self._indexing = False
+
+        self._indexing = True
+        task = asyncio.ensure_future(reindex())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def tile_sync(self, z: int, x: int, y: int) -> Optional[LazyTile]:
         tile_data = self.src.read_tile(z=z, x=x, y=y)
         if not tile_data:
-            return [None, None]
+            return None
         else:
-            tile_data = gzip.decompress(tile_data)
-            return [vector_tile_base.VectorTile(tile_data), tile_data]
+            return LazyTile.from_blob(tile_data)
+
+    async def tile(
+        self, z: int, x: int, y: int, headers, url_params: str
+    ) -> Optional[LazyTile]:
+        return await self.src.run(self.tile_sync, z, x, y)
+
+    def tiles_sync(
+        self, z: int, tiles: Iterable[Tuple[int, int]]
+    ) -> Dict[Tuple[int, int], LazyTile]:
+        return {
+            tile: LazyTile.from_blob(tile_data)
+            for tile, tile_data in self.src.read_tiles(z, tiles).items()
+            if tile_data
+        }
+
+    async def tiles(
+        self, z: int, tiles: Iterable[Tuple[int, int]]
+    ) -> Dict[Tuple[int, int], LazyTile]:
+        """
+        Read many tiles of a zoom level at once, for seeding or metatiles.
+        """
+        return await self.src.run(self.tiles_sync, z, list(tiles))
+
+    async def tilejson(self, headers, url_params: str):
+        return await self.src.run(self.src.metadata)
+
+    def version(self) -> Optional[str]:
+        return self.src.version()
+
+
+class SourcePrefetched(Source):
+    """
+    Tiles of a zoom level of a source, read in bulk before the merge. Same
+    as the source for the feature cache.
+    """
 
-    def tilejson(self, headers, url_params: str):
-        return self.src.meta
+    def __init__(self, source: Source, tiles: Dict[Tuple[int, int], LazyTile]):
+        self.source = source
+        self.tiles = tiles
+
+    def __eq__(self, other):
+        return self.source == other
+
+    def __hash__(self):
+        return hash(self.source)
+
+    async def tile(
+        self, z: int, x: int, y: int, headers, url_params: str
+    ) -> Optional[LazyTile]:
+        return self.tiles.get((x, y))
+
+    def may_have_tile(self, z: int, x: int, y: int) -> bool:
+        return (x, y) in self.tiles
+
+    def version(self) -> Optional[str]:
+        return self.source.version()
+
+
+_NOT_CACHED = object()
+
+
+def negative_cache(ttl: Optional[float]) -> Optional[LRUCache]:
+    """
+    Disabled with a ttl of 0.
+    """
+    if ttl is not None and ttl <= 0:
+        return None
+    return LRUCache(max_size=int(upstream_config["negative_cache_size"]), ttl=ttl)
+
+
+def remember(cache: Optional[LRUCache], url: str, error: Optional[Exception]):
+    if cache is not None:
+        cache.set(url, error, 1)
 
 
 class SourceXYZ(Source):
-    def __init__(self, template_url: str):
-        self.template_url = template_url
-
-    def tile(self, z: int, x: int, y: int, headers, url_params: str):
-        url = self.template_url.format_map({"z": z, "x": x, "y": y})
-        if url_params:
-            url = f"{url}?{url_params}"
-        r = requests.get(url, headers=headers)
-        r.raise_for_status()
-        return [vector_tile_base.VectorTile(r.content), r.content]
+    """
+    Upstream tiles server. Missing and empty tiles, then errors, are cached
+    for a short time. Calls fail fast with CircuitOpenError while the
+    upstream is down.
+
+    Failed fetches are retried with a jittered backoff, within the deadline
+    of the tile. With mirrors, alternative template URLs, retries go to the
+    next mirror and a fetch slower than the usual latency is hedged by a
+    second one to the next mirror.
+    """
+
+    def __init__(self, template_url: Union[str, List[str]]):
+        self.template_urls = (
+            [template_url] if isinstance(template_url, str) else list(template_url)
+        )
+        self._fetches = SingleFlight()
+        self.circuit_breaker = CircuitBreaker(
+            urlsplit(self.template_url).netloc,
+            failure_threshold=int(upstream_config["failure_threshold"]),
+            reset_timeout=float(upstream_config["reset_timeout"]),
+        )
+        # Values are the error to raise again, or None for an empty tile
+        self._missing = negative_cache(upstream_config["negative_ttl"])
+        self._errors = negative_cache(upstream_config["error_ttl"])
+        # Recent successful fetch durations, for the hedge delay
+        self._latencies: Deque[float] = deque(maxlen=200)
+
+    @property
+    def template_url(self) -> str:
+        return self.template_urls[0]
+
+    async def _get(
+        self, url: str, headers
+    ) -> Tuple[int, Tuple[bytes, Optional[str], Optional[str]]]:
+        async with http_client(url).stream("GET", url, headers=headers) as r:
+            r.raise_for_status()
+            encoded = b"".join([chunk async for chunk in r.aiter_raw()])
+
+        etag = r.headers.get("ETag")
+        return r.status_code, (
+            encoded,
+            r.headers.get("Content-Encoding"),
+            # The encoding is part of a strong validator
+            etag and f"{etag},{r.headers.get('Content-Encoding')}",
+        )
+
+    async def _fetch(
+        self, url: str, headers
+    ) -> Tuple[bytes, Optional[str], Optional[str]]:
+        """
+        Fetch a tile, without decompressing it. A single attempt, bounded by
+        the timeout and the deadline.
+        """
+        headers = {
+            **forward_headers(headers, drop={"accept-encoding"}),
+            "Accept-Encoding": "gzip",
+        }
+        timeout = attempt_timeout()
+        cut_short = timeout < float(upstream_config["timeout"])
+        start = time.perf_counter()
+        status = "error"
+        try:
+            status_code, fetched = await asyncio.wait_for(
+                self._get(url, headers), timeout
+            )
+            status = str(status_code)
+            self._latencies.append(time.perf_counter() - start)
+            return fetched
+        except httpx.HTTPStatusError as error:
+            status = str(error.response.status_code)
+            raise
+        except asyncio.TimeoutError:
+            if cut_short:
+                status = "deadline"
+                raise DeadlineExceeded(f"Deadline exceeded after {timeout:.2f}s: {url}")
+            status = "timeout"
+            raise httpx.TimeoutException(f"Timeout after {timeout:.2f}s: {url}")
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            observe_upstream(urlsplit(url).netloc, status, time.perf_counter() - start)
+
+    def _hedge_delay(self) -> Optional[float]:
+        percentile = upstream_config["hedge_percentile"]
+        if percentile is None or len(self._latencies) < 20:
+            return None
+        latencies = sorted(self._latencies)
+        index = min(int(len(latencies) * percentile / 100), len(latencies) - 1)
+        return max(latencies[index], float(upstream_config["hedge_min_delay"]))
+
+    async def _fetch_hedged(
+        self, urls: List[str], headers
+    ) -> Tuple[bytes, Optional[str], Optional[str]]:
+        """
+        Fetch from the first mirror, and also from the second one when the
+        first is slower than the hedge delay. The first success wins.
+        """
+        delay = self._hedge_delay() if len(urls) > 1 else None
+        if delay is None:
+            return await self._fetch(urls[0], headers)
+
+        fetches = [asyncio.ensure_future(self._fetch(urls[0], headers))]
+        try:
+            done, _ = await asyncio.wait(fetches, timeout=delay)
+            if not done:
+                count_upstream_retry(self.circuit_breaker.name, "hedge")
+                fetches.append(asyncio.ensure_future(self._fetch(urls[1], headers)))
+
+            pending = set(fetches)
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for fetch in done:
+                    if not fetch.exception():
+                        return fetch.result()
+                if not pending:
+                    # Both failed
+                    return done.pop().result()
+        finally:
+            for fetch in fetches:
+                fetch.cancel()
+
+    async def _fetch_retried(
+        self, urls: List[str], headers
+    ) -> Tuple[bytes, Optional[str], Optional[str]]:
+        retries = int(upstream_config["retries"])
+        attempt = 0
+        while True:
+            # Each retry starts with the next mirror
+            shift = attempt % len(urls)
+            try:
+                return await self._fetch_hedged(urls[shift:] + urls[:shift], headers)
+            except (httpx.HTTPStatusError, httpx.TransportError) as error:
+                if attempt >= retries or not is_upstream_failure(error):
+                    raise
+                # Full jitter
+                backoff = random.uniform(
+                    0, float(upstream_config["retry_backoff"]) * 2 ** attempt
+                )
+                left = remaining()
+                if left is not None and left <= backoff:
+                    raise
+            count_upstream_retry(self.circuit_breaker.name, "retry")
+            await asyncio.sleep(backoff)
+            attempt += 1
+
+    def _record_health(self, error: Optional[Exception], seconds: float):
+        slow_call = upstream_config["slow_call"]
+        if error is not None and is_upstream_failure(error):
+            self.circuit_breaker.failure()
+        elif slow_call is not None and seconds > slow_call:
+            self.circuit_breaker.failure()
+        else:
+            self.circuit_breaker.success()
+
+    async def _fetch_cached(
+        self, urls: List[str], headers
+    ) -> Optional[Tuple[bytes, Optional[str], Optional[str]]]:
+        url = urls[0]
+        try:
+            self.circuit_breaker.check()
+        except CircuitOpenError:
+            count_upstream_skipped(self.circuit_breaker.name, "circuit_open")
+            raise
+
+        start = time.perf_counter()
+        try:
+            fetched = await self._fetch_retried(urls, headers)
+        except DeadlineExceeded:
+            self.circuit_breaker.release()
+            raise
+        except httpx.HTTPStatusError as error:
+            self._record_health(error, time.perf_counter() - start)
+            if error.response.status_code == 404:
+                remember(self._missing, url, error)
+            else:
+                remember(self._errors, url, error)
+            raise
+        except httpx.TransportError as error:
+            self._record_health(error, time.perf_counter() - start)
+            remember(self._errors, url, error)
+            raise
+        except BaseException:
+            # Cancelled or unexpected, tells nothing of the upstream health
+            self.circuit_breaker.release()
+            raise
+        self._record_health(None, time.perf_counter() - start)
+
+        if not fetched[0]:
+            # 204 or empty body
+            remember(self._missing, url, None)
+            return None
+        return fetched
+
+    async def tile(
+        self, z: int, x: int, y: int, headers, url_params: str
+    ) -> Optional[LazyTile]:
+        urls = [
+            template_url.format_map({"z": z, "x": x, "y": y})
+            + (f"?{url_params}" if url_params else "")
+            for template_url in self.template_urls
+        ]
+        url = urls[0]
+
+        for reason, cache in [("missing", self._missing), ("error", self._errors)]:
+            if cache is None:
+                continue
+            error = cache.get(url, _NOT_CACHED)
+            if error is not _NOT_CACHED:
+                count_upstream_skipped(self.circuit_breaker.name, reason)
+                if error is None:
+                    return None
+                raise error.with_traceback(None)
+
+        # Share the fetch, but not the decoded tile
+        fetched = await self._fetches.do(url, lambda: self._fetch_cached(urls, headers))
+        if fetched is None:
+            return None
+        encoded, encoding, etag = fetched
+        return LazyTile(
+            encoded=encoded, encoding=encoding, etag=etag or make_etag(encoded)
+        )
 
 
 class SourceTileJSON(SourceXYZ):
-    def __init__(self, tilejson_url: str, tile_url: str = None):
-        r = requests.get(tilejson_url)
+    def __init__(self, tilejson_url: str, tile_url: Union[str, List[str], None] = None):
+        """
+        tile_url replaces the host of the TileJSON tiles URL, a list of them
+        for mirrors.
+        """
+        self.tilejson_url = tilejson_url
+        r = requests.get(tilejson_url, timeout=upstream_config["timeout"])
         r.raise_for_status()
         self._tilejson = r.json()
 
         template_url = self._tilejson["tiles"][0]
         if tile_url:
-            template_url = template_url[
-                template_url.index("/", template_url.index("//") + 3) :
-            ]
-            template_url = tile_url + template_url
-
-        super().__init__(template_url)
+            path = template_url[template_url.index("/", template_url.index("//") + 3) :]
+            tile_urls = [tile_url] if isinstance(tile_url, str) else tile_url
+            super().__init__([tile_url + path for tile_url in tile_urls])
+        else:
+            super().__init__(template_url)
 
-    def tilejson(self, headers, url_params: str):
-        return self._tilejson
+    async def tilejson(self, headers, url_params: str):
+        return await fetch_json(self.tilejson_url)
 
 
 def sourceFactory(source) -> Source:
@@ -65,6 +715,8 @@ def sourceFactory(source) -> Source:
             tilejson_url=source.get("tilejson_url"), tile_url=source.get("tile_url")
         )
     elif "mbtiles" in source:
-        return SourceMBTiles(mbtiles=source.get("mbtiles"))
+        return SourceMBTiles(
+            mbtiles=source.get("mbtiles"), index=bool(source.get("index"))
+        )
     else:
         raise NotImplementedError(source)
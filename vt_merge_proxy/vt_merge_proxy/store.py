@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from .compression import compression_level
+from .sources import LazyTile
+
+logger = logging.getLogger(__name__)
+
+TileKey = Tuple[str, int, int, int, str]  # data_id, z, x, y, query
+
+
+class TileStore:
+    """
+    Persistent store of merged tiles in a SQLite file, using the MBTiles tile
+    coordinates and gzip compression. Entries older than ttl are served stale
+    while re-merged in background. Entries of an other version, eg. made from
+    an older partial MBTiles, are ignored and removed. Degraded tiles are not
+    stored. Tiles keep the etag they were merged with.
+
+    The store is purged every purge_interval seconds, of the entries older
+    than max_age, then of the oldest ones over max_size tiles.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: Optional[float] = None,
+        max_size: Optional[int] = None,
+        max_age: Optional[float] = None,
+        purge_interval: float = 60,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_age = max_age
+        self.purge_interval = purge_interval
+        self._purged_at = time.monotonic()
+        self._local = threading.local()
+        self._versions: Dict[str, str] = {}
+        self._revalidating: Set[TileKey] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+        with self._connection() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS tiles (
+                    data_id TEXT NOT NULL,
+                    zoom_level INTEGER NOT NULL,
+                    tile_column INTEGER NOT NULL,
+                    tile_row INTEGER NOT NULL,
+                    query TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    tile_data BLOB,
+                    etag TEXT,
+                    PRIMARY KEY (data_id, zoom_level, tile_column, tile_row, query)
+                )
+                """
+            )
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(tiles)")]
+            if "etag" not in columns:
+                # Store made by an older version
+                connection.execute("ALTER TABLE tiles ADD COLUMN etag TEXT")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS tiles_created_at ON tiles (created_at)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _read(
+        self, key: TileKey, version: str
+    ) -> Optional[Tuple[Optional[bytes], float, Optional[str]]]:
+        data_id, z, x, y, query = key
+        with self._connection() as connection:
+            if self._versions.get(data_id) != version:
+                connection.execute(
+                    "DELETE FROM tiles WHERE data_id = ? AND version != ?",
+                    (data_id, version),
+                )
+                self._versions[data_id] = version
+
+            row = connection.execute(
+                """
+                SELECT tile_data, created_at, etag
+                FROM tiles
+                WHERE
+                    data_id = ? AND
+                    zoom_level = ? AND tile_column = ? AND tile_row = ? AND
+                    query = ? AND
+                    version = ? AND
+                    created_at >= ?
+                """,
+                (data_id, z, x, 2 ** z - 1 - y, query, version, self._expired_at()),
+            ).fetchone()
+        return row
+
+    def _expired_at(self) -> float:
+        return time.time() - self.max_age if self.max_age is not None else 0
+
+    def purge(self):
+        with self._connection() as connection:
+            if self.max_age is not None:
+                connection.execute(
+                    "DELETE FROM tiles WHERE created_at < ?", (self._expired_at(),)
+                )
+            if self.max_size is not None:
+                connection.execute(
+                    """
+                    DELETE FROM tiles
+                    WHERE rowid IN (
+                        SELECT rowid
+                        FROM tiles
+                        ORDER BY created_at DESC
+                        LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_size,),
+                )
+
+    def _write(self, key: TileKey, version: str, tile: Optional[LazyTile]):
+        data_id, z, x, y, query = key
+        tile_data = tile and tile.encode("gzip", compression_level("gzip"))
+        with self._connection() as connection:
+            connection.execute(
+                """
+                INSERT OR REPLACE INTO tiles
+                    (data_id, zoom_level, tile_column, tile_row, query, version,
+                    created_at, tile_data, etag)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    data_id,
+                    z,
+                    x,
+                    2 ** z - 1 - y,
+                    query,
+                    version,
+                    time.time(),
+                    tile_data,
+                    tile and tile.etag,
+                ),
+            )
+
+        if time.monotonic() - self._purged_at >= self.purge_interval:
+            self._purged_at = time.monotonic()
+            self.purge()
+
+    async def get(
+        self,
+        key: TileKey,
+        version: str,
+        merge: Callable[[], Awaitable[Optional[LazyTile]]],
+    ) -> Optional[LazyTile]:
+        entry = await asyncio.to_thread(self._read, key, version)
+        if entry is not None:
+            tile_data, created_at, etag = entry
+            if self.ttl is not None and created_at + self.ttl < time.time():
+                self._revalidate(key, version, merge)
+            return LazyTile.from_blob(tile_data, etag) if tile_data else None
+
+        tile = await merge()
+        if not (tile and tile.degraded):
+            await asyncio.to_thread(self._write, key, version, tile)
+        return tile
+
+    def _revalidate(
+        self,
+        key: TileKey,
+        version: str,
+        merge: Callable[[], Awaitable[Optional[LazyTile]]],
+    ):
+        if key in self._revalidating:
+            return
+
+        async def revalidate():
+            try:
+                tile = await merge()
+                if not (tile and tile.degraded):
+                    await asyncio.to_thread(self._write, key, version, tile)
+            except Exception:
+                logger.exception(f"Fails to revalidate stored tile {key}")
+            finally:
+                self._revalidating.discard(key)
+
+        self._revalidating.add(key)
+        task = asyncio.ensure_future(revalidate())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -1,14 +1,13 @@
+import copy
 from typing import Any, Dict
 
-import requests
 from mergedeep import merge
 
 
 class StyleGL:
-    def __init__(self, url: str, overwrite: Dict[str, Any] = None):
-        r = requests.get(url)
-        r.raise_for_status()
-        self._gljson = r.json()
+    def __init__(self, gljson: Dict[str, Any], overwrite: Dict[str, Any] = None):
+        # The upstream style is shared by the requests
+        self._gljson = copy.deepcopy(gljson)
 
         if overwrite:
             self._gljson = merge(self._gljson, overwrite)
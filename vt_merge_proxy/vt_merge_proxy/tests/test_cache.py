@@ -0,0 +1,62 @@
+import time
+
+from prometheus_client import REGISTRY
+
+from ..cache import LRUCache
+
+
+def test_lru_cache_evict_by_size():
+    cache = LRUCache(max_size=10)
+    cache.set("a", 1, size=4)
+    cache.set("b", 2, size=4)
+    assert cache.get("a") == 1
+    cache.set("c", 3, size=4)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.size == 8
+    assert cache.hits == 3
+    assert cache.misses == 1
+
+
+def test_lru_cache_too_large():
+    cache = LRUCache(max_size=10)
+    cache.set("a", 1, size=11)
+
+    assert cache.get("a") is None
+    assert cache.size == 0
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(max_size=10, ttl=0.01)
+    cache.set("a", 1, size=1)
+    time.sleep(0.02)
+
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_lru_cache_metrics():
+    def lookups(result):
+        return (
+            REGISTRY.get_sample_value(
+                "vt_merge_cache_lookups_total", {"cache": "test", "result": result}
+            )
+            or 0
+        )
+
+    cache = LRUCache(max_size=10, name="test")
+    cache.set("a", 1, size=1)
+    hits, misses = lookups("hit"), lookups("miss")
+    cache.get("a")
+    cache.get("b")
+    assert (lookups("hit"), lookups("miss")) == (hits + 1, misses + 1)
+
+
+def test_lru_cache_ttl_zero():
+    cache = LRUCache(max_size=10, ttl=0)
+    cache.set("a", 1, size=1)
+    time.sleep(0.001)
+
+    assert cache.get("a") is None
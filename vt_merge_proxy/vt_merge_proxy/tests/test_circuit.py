@@ -0,0 +1,73 @@
+import asyncio
+
+import httpx
+import pytest
+
+from ..circuit import CircuitBreaker, CircuitOpenError
+from ..sources import SourceXYZ, _http_clients, close_http_clients
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker("upstream", failure_threshold=2, reset_timeout=60)
+    breaker.check()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == "closed"
+
+    breaker.failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.check()
+    assert error.value.retry_after > 1
+
+
+def test_circuit_breaker_half_open():
+    breaker = CircuitBreaker("upstream", failure_threshold=1, reset_timeout=0)
+    breaker.failure()
+    assert breaker.state == "half_open"
+
+    # A single trial call
+    breaker.check()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    breaker.failure()
+    breaker.check()
+    breaker.success()
+    assert breaker.state == "closed"
+    breaker.check()
+    breaker.check()
+
+
+def test_circuit_breaker_cancelled_trial():
+    async def handler(request):
+        if request.url.path == "/14/1/1.pbf":
+            await asyncio.sleep(10)
+        return httpx.Response(200, stream=httpx.ByteStream(b"tile"))
+
+    async def run():
+        _http_clients["http://upstream"] = httpx.AsyncClient(
+            transport=httpx.MockTransport(handler)
+        )
+        source = SourceXYZ("http://upstream/{z}/{x}/{y}.pbf")
+        breaker = source.circuit_breaker
+        breaker.failure_threshold = 1
+        breaker.reset_timeout = 0
+        breaker.failure()
+        try:
+            trial = asyncio.ensure_future(
+                source._fetch_cached(["http://upstream/14/1/1.pbf"], {})
+            )
+            await asyncio.sleep(0.01)
+            trial.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await trial
+
+            # The trial call is given back to the next one
+            assert (await source.tile(14, 1, 2, {}, "")).raw == b"tile"
+            assert breaker.state == "closed"
+        finally:
+            await close_http_clients()
+
+    asyncio.run(run())
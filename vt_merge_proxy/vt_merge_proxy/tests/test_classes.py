@@ -0,0 +1,43 @@
+from ..classes import ClassMatcher
+
+FIELDS = ["superclass", "class", "subclass"]
+
+
+def test_class_matcher():
+    matcher = ClassMatcher(
+        [
+            ["amenity", "restaurant"],
+            ["shop", "bakery", "pastry"],
+            ["leisure", None, "park"],
+        ]
+    )
+
+    assert matcher.match(FIELDS, {"superclass": "amenity", "class": "restaurant"})
+    assert matcher.match(
+        FIELDS, {"superclass": "amenity", "class": "restaurant", "subclass": "pizza"}
+    )
+    assert not matcher.match(FIELDS, {"superclass": "amenity", "class": "cafe"})
+    assert not matcher.match(FIELDS, {"superclass": "shop", "class": "bakery"})
+    assert matcher.match(
+        FIELDS, {"superclass": "shop", "class": "bakery", "subclass": "pastry"}
+    )
+    assert matcher.match(FIELDS, {"superclass": "leisure", "subclass": "park"})
+    assert not matcher.match(FIELDS, {})
+
+
+def test_class_matcher_empty():
+    assert not ClassMatcher([])
+    assert ClassMatcher([[]]).match(FIELDS, {"superclass": "amenity"})
+    assert not ClassMatcher([FIELDS + ["more"]]).match(
+        FIELDS, {"superclass": "superclass", "class": "class", "subclass": "subclass"}
+    )
+
+
+def test_class_matcher_list_values():
+    matcher = ClassMatcher([["amenity", ["restaurant", "bar"]]])
+
+    assert matcher.match(
+        FIELDS, {"superclass": "amenity", "class": ["restaurant", "bar"]}
+    )
+    assert not matcher.match(FIELDS, {"superclass": "amenity", "class": ["bar"]})
+    assert not matcher.match(FIELDS, {"superclass": "amenity", "class": {"a": 1}})
@@ -0,0 +1,15 @@
+from ..compression import accepted_encodings, compress, decompress
+
+
+def test_accepted_encodings():
+    assert accepted_encodings(None) == set()
+    assert accepted_encodings("gzip, deflate, br") == {"gzip", "deflate", "br"}
+    assert accepted_encodings("gzip;q=0.5, br;q=0") == {"gzip"}
+    assert "gzip" in accepted_encodings("*")
+
+
+def test_compress():
+    data = b"tile" * 100
+    assert decompress(compress(data, "gzip", 6), "gzip") == data
+    assert compress(data, "gzip") == compress(data, "gzip")
+    assert decompress(data, None) == data
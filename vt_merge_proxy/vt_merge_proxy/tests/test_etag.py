@@ -0,0 +1,16 @@
+from ..etag import etag_matches, make_etag
+
+
+def test_make_etag():
+    assert make_etag("a", b"b") == make_etag(b"a", "b")
+    assert make_etag("ab", "") != make_etag("a", "b")
+    assert make_etag(None, "a") == make_etag("", "a")
+
+
+def test_etag_matches():
+    assert etag_matches('"abc"', "abc")
+    assert etag_matches('"xyz", W/"abc"', "abc")
+    assert etag_matches('"abc-gzip"', "abc")
+    assert etag_matches("*", "abc")
+    assert not etag_matches('"xyz"', "abc")
+    assert not etag_matches(None, "abc")
@@ -0,0 +1,109 @@
+import asyncio
+import json
+
+import yaml
+from prometheus_client import REGISTRY
+
+from ..compression import compress
+from ..config import merge_config_factory
+from ..executor import MergeExecutor, parts_tile, tile_parts
+from ..merge import merge_tile_data
+from ..metrics import tile_labels
+from ..sources import LazyTile
+from .test_merge import decode_layer, encode_tile, poi
+
+
+def test_tile_parts():
+    tile = LazyTile(encoded=compress(b"tile", "gzip"), encoding="gzip", etag="e")
+    assert tile_parts(tile) == (tile.encoded, "gzip", "e")
+    assert parts_tile(tile_parts(tile)).raw == b"tile"
+    assert parts_tile(tile_parts(LazyTile(raw=b"tile"))).raw == b"tile"
+    assert tile_parts(None) is None
+
+
+def test_thread_executor():
+    executor = MergeExecutor(type="thread", workers=2)
+    full = LazyTile(raw=b"full")
+
+    async def run():
+        tile_labels.set(("localhost", "default"))
+        # Nothing to merge, the full tile is kept
+        tile = await executor.merge("default", full, [None], [{}], 14, 1, 2, None, None)
+        assert tile is full
+
+    asyncio.run(run())
+    executor.shutdown()
+
+
+def test_process_executor(tmp_path):
+    with open(tmp_path / "classes.json", "w") as f:
+        json.dump([["amenity", "restaurant"]], f)
+    source_conf = {
+        "hosts": ["localhost"],
+        "sources": {
+            "full": {"mbtiles": str(tmp_path / "full.mbtiles")},
+            "partial": {"mbtiles": str(tmp_path / "partial.mbtiles")},
+        },
+        "merge_layers": {
+            "poi": {
+                "fields": ["superclass", "class"],
+                "classes": str(tmp_path / "classes.json"),
+            }
+        },
+        "output": {"min_zoom": 14},
+    }
+    with open(tmp_path / "config.yaml", "w") as f:
+        yaml.dump({"sources": {"default": source_conf}}, f)
+    layers = merge_config_factory(source_conf, with_sources=False).layers
+
+    full = encode_tile(
+        {
+            "poi": [
+                poi(10, 10, "amenity", "school", "S"),
+                poi(20, 20, "amenity", "restaurant", "R"),
+            ],
+            "road": [(1, 2, {"kind": "primary"})],
+        }
+    )
+    full = LazyTile(encoded=compress(full.raw, "gzip"), encoding="gzip", etag="f")
+    partial = encode_tile({"poi": [poi(30, 30, "amenity", "restaurant", "P")]})
+    inline = merge_tile_data(full, [partial], layers, 14, 1, 2, None)
+
+    def merged():
+        return (
+            REGISTRY.get_sample_value(
+                "vt_merge_tiles_total",
+                {
+                    "host": "process",
+                    "data_id": "default",
+                    "zoom": "14",
+                    "result": "merged",
+                },
+            )
+            or 0
+        )
+
+    async def merge():
+        tile_labels.set(("process", "default"))
+        return await executor.merge(
+            "default", full, [partial], layers, 14, 1, 2, None, None
+        )
+
+    # Workers load the config and merge from the pickled tile parts
+    executor = MergeExecutor(
+        type="process", workers=1, config_path=str(tmp_path / "config.yaml")
+    )
+    before = merged()
+    try:
+        tile = asyncio.run(merge())
+    finally:
+        executor.shutdown()
+    # Metrics of the worker observed by the server process
+    assert merged() == before + 1
+
+    assert [attributes["name"] for _, attributes in decode_layer(tile, "poi")] == [
+        "S",
+        "P",
+    ]
+    assert tile.raw == inline.raw
+    assert tile.etag == inline.etag
@@ -0,0 +1,63 @@
+import asyncio
+import os
+import sqlite3
+
+from ..mbtiles import MBTilesReader, MBTilesWriter
+
+
+def mbtiles(path, tiles):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+    connection.execute(
+        "CREATE TABLE tiles "
+        "(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+    )
+    connection.execute("INSERT INTO metadata VALUES ('name', 'test')")
+    connection.executemany(
+        "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+        [(z, x, 2 ** z - 1 - y, data) for (z, x, y), data in tiles.items()],
+    )
+    connection.commit()
+    connection.close()
+
+
+def test_mbtiles_reader(tmp_path):
+    path = str(tmp_path / "test.mbtiles")
+    mbtiles(path, {(14, 1, 2): b"a", (14, 2, 2): b"b", (14, 3, 3): b"c"})
+    reader = MBTilesReader(path)
+
+    assert reader.metadata() == {"name": "test"}
+    assert reader.read_tile(14, 1, 2) == b"a"
+    assert reader.read_tile(14, 1, 3) is None
+    assert reader.read_tiles(14, [(1, 2), (3, 3), (1, 3)]) == {
+        (1, 2): b"a",
+        (3, 3): b"c",
+    }
+    assert asyncio.run(reader.run(reader.read_tile, 14, 2, 2)) == b"b"
+    assert set(reader.read_tile_coords()) == {(14, 1, 2), (14, 2, 2), (14, 3, 3)}
+
+
+def test_mbtiles_reader_replaced(tmp_path):
+    path = str(tmp_path / "test.mbtiles")
+    mbtiles(path, {(14, 1, 2): b"a"})
+    reader = MBTilesReader(path)
+    assert reader.read_tile(14, 1, 2) == b"a"
+
+    mbtiles(path + ".new", {(14, 1, 2): b"new"})
+    os.replace(path + ".new", path)
+    assert reader.read_tile(14, 1, 2) == b"new"
+
+
+def test_mbtiles_writer(tmp_path):
+    path = str(tmp_path / "test.mbtiles")
+    writer = MBTilesWriter(path)
+    writer.write_metadata({"name": "test", "format": "pbf"})
+    writer.write_tiles(14, [(1, 2, b"a"), (3, 3, b"c")])
+    writer.write_tiles(14, [(1, 2, b"b")])
+    assert writer.existing_tiles(14) == {(1, 2), (3, 3)}
+    writer.close()
+
+    reader = MBTilesReader(path)
+    assert reader.metadata() == {"name": "test", "format": "pbf"}
+    assert reader.read_tile(14, 1, 2) == b"b"
+    assert reader.read_tile(14, 3, 3) == b"c"
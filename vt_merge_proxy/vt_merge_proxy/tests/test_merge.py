@@ -0,0 +1,369 @@
+import asyncio
+
+import httpx
+import vector_tile_base  # type: ignore
+
+from .. import merge
+from ..classes import ClassMatcher
+from ..config import LayerConfig
+from ..merge import (
+    RankConfig,
+    merge_tile,
+    merge_tile_data,
+    merge_tilejson,
+    merge_tiles,
+    rank,
+)
+from ..sources import LazyTile, Source
+
+
+class Feature:
+    def __init__(self, x, y, **attributes):
+        self.geometry = [[x, y]]
+        self.attributes = attributes
+
+    def get_geometry(self):
+        return self.geometry
+
+
+def test_rank():
+    features = [
+        Feature(0, 0, zoom=16),
+        Feature(10, 10, zoom=14, priority=2),
+        Feature(20, 20, zoom=14, priority=1),
+        Feature(1000, 1000),
+        Feature(30, 30),
+    ]
+
+    assert rank(features) == [2, 1, 0, 0, 3]
+
+
+def test_rank_config():
+    features = [
+        Feature(0, 0, priority=1),
+        Feature(90, 0, priority=2),
+        Feature(400, 0, priority=3),
+    ]
+
+    assert rank(features, RankConfig(grid_size=1000, sort=[])) == [0, 1, 2]
+    assert rank(
+        features,
+        RankConfig(grid_size=1000, sort=[{"field": "priority", "default": 0}]),
+    ) == [0, 1, 2]
+    assert rank(
+        features,
+        RankConfig(grid_size=200, sort=[{"field": "priority", "default": 0}]),
+    ) == [0, 1, 0]
+
+
+def test_merge_tilejson():
+    tilejson = merge_tilejson(
+        ["http://localhost/data/default/{z}/{x}/{y}.pbf"],
+        {"attribution": "OSM", "vector_layers": [{"id": "poi"}]},
+        [
+            {"attribution": "Restaurants", "vector_layers": [{"id": "food"}]},
+            {"attribution": "Events"},
+        ],
+        [["poi", "food"], ["food", "event"]],
+        url_params="",
+    )
+
+    assert tilejson["tiles"] == ["http://localhost/data/default/{z}/{x}/{y}.pbf"]
+    assert set(tilejson["attribution"].split(" ")) == {"OSM", "Restaurants", "Events"}
+    assert tilejson["vector_layers"] == [{"id": "poi"}, {"id": "food"}, {"id": "event"}]
+
+
+class SourceTiles(Source):
+    def __init__(self, tiles):
+        self.tiles = tiles
+
+    async def tile(self, z, x, y, headers, url_params):
+        return self.tiles.get((x, y))
+
+
+def test_merge_tiles():
+    full = {(0, 0): LazyTile(raw=b"0"), (0, 1): LazyTile(raw=b"1")}
+    merged = asyncio.run(
+        merge_tiles(
+            0,
+            SourceTiles(full),
+            [SourceTiles({})],
+            [{}],
+            1,
+            [(0, 0), (0, 1), (1, 1)],
+            headers={},
+            url_params="",
+            tile_in_poly=None,
+        )
+    )
+
+    # Nothing to merge, the full tiles are kept
+    assert merged == {(0, 0): full[(0, 0)], (0, 1): full[(0, 1)], (1, 1): None}
+
+
+def encode_tile(layers) -> LazyTile:
+    """
+    Tile of point features, from layer names to lists of (x, y, attributes).
+    """
+    tile = vector_tile_base.VectorTile()
+    for layer_name, features in layers.items():
+        layer = tile.add_layer(layer_name)
+        for i, (x, y, attributes) in enumerate(features):
+            feature = layer.add_point_feature()
+            feature.add_points([[x, y]])
+            feature.attributes = attributes
+            feature.id = i + 1
+    return LazyTile(raw=tile.serialize())
+
+
+def decode_layer(tile: LazyTile, layer_name: str):
+    layer = next(
+        layer
+        for layer in vector_tile_base.VectorTile(tile.raw).layers
+        if layer.name == layer_name
+    )
+    return [
+        (
+            f.get_geometry()[0],
+            {key: f.attributes[key] for key in f.attributes},
+        )
+        for f in layer.features
+    ]
+
+
+FIELDS = ["superclass", "class"]
+
+
+def poi_layer_config(classes, precedence=0, rank=RankConfig()):
+    return LayerConfig(
+        fields=FIELDS,
+        classes=ClassMatcher(classes),
+        rank=rank,
+        precedence=precedence,
+    )
+
+
+def test_merge_tile_data_round_trip(monkeypatch):
+    def fail(*args):
+        raise AssertionError("Features must be copied without re-encoding")
+
+    monkeypatch.setattr(merge, "build_feature", fail)
+
+    full = encode_tile(
+        {
+            "poi": [
+                (10, 10, {"superclass": "amenity", "class": "school", "name": "S"}),
+                (20, 20, {"superclass": "amenity", "class": "restaurant"}),
+                (30, 30, {"superclass": "shop", "class": "bakery", "zoom": 16}),
+            ],
+            "road": [(1, 2, {"kind": "primary"})],
+            "water": [(3, 4, {"kind": "lake", "area": 1.5})],
+        }
+    )
+    partial = encode_tile(
+        {
+            "poi": [
+                (25, 25, {"superclass": "amenity", "class": "restaurant", "name": "R"}),
+                (40, 40, {"superclass": "amenity", "class": "school"}),
+            ],
+        }
+    )
+
+    merged = merge_tile_data(
+        full,
+        [partial],
+        [{"poi": poi_layer_config([["amenity", "restaurant"]])}],
+        14,
+        1,
+        2,
+        None,
+    )
+
+    # Excluded classes removed from the full tile, included ones added from
+    # the partial tile, with their geometry, attributes and a rank
+    poi = decode_layer(merged, "poi")
+    assert [(point, attributes.pop("rank")) for point, attributes in poi] == [
+        ([10, 10], 1),
+        ([30, 30], 0),
+        ([25, 25], 2),
+    ]
+    assert [attributes for _, attributes in poi] == [
+        {"superclass": "amenity", "class": "school", "name": "S"},
+        {"superclass": "shop", "class": "bakery", "zoom": 16},
+        {"superclass": "amenity", "class": "restaurant", "name": "R"},
+    ]
+
+    # Other layers spliced byte for byte
+    assert merged.raw_layer("road") == full.raw_layer("road")
+    assert merged.raw_layer("water") == full.raw_layer("water")
+
+
+def poi(x, y, superclass, classs, name):
+    return (x, y, {"superclass": superclass, "class": classs, "name": name})
+
+
+def test_merge_tile_data_precedence():
+    full = encode_tile(
+        {
+            "poi": [
+                poi(10, 10, "amenity", "school", "S"),
+                poi(20, 20, "amenity", "restaurant", "full"),
+            ]
+        }
+    )
+    partial_a = encode_tile({"poi": [poi(30, 30, "amenity", "restaurant", "A")]})
+    partial_b = encode_tile(
+        {
+            "poi": [
+                poi(40, 40, "amenity", "restaurant", "B"),
+                poi(50, 50, "tourism", "hotel", "H"),
+            ]
+        }
+    )
+
+    merged = merge_tile_data(
+        full,
+        [partial_a, partial_b],
+        [
+            {"poi": poi_layer_config([["amenity", "restaurant"]], precedence=1)},
+            {
+                "poi": poi_layer_config(
+                    [["amenity", "restaurant"], ["tourism", "hotel"]], precedence=0
+                )
+            },
+        ],
+        14,
+        1,
+        2,
+        None,
+    )
+
+    # B merged first, then its restaurants replaced by the ones of A
+    assert [attributes["name"] for _, attributes in decode_layer(merged, "poi")] == [
+        "S",
+        "H",
+        "A",
+    ]
+
+
+def test_merge_tile_data_source_layers():
+    full = encode_tile(
+        {
+            "poi": [poi(10, 10, "amenity", "school", "S")],
+            "event": [(10, 10, {"name": "E0"})],
+        }
+    )
+    partial_a = encode_tile({"poi": [poi(30, 30, "amenity", "restaurant", "A")]})
+    partial_b = encode_tile(
+        {
+            "poi": [poi(40, 40, "amenity", "restaurant", "B")],
+            "event": [(20, 20, {"name": "E1"})],
+        }
+    )
+
+    merged = merge_tile_data(
+        full,
+        [partial_a, partial_b],
+        [
+            {"poi": poi_layer_config([["amenity", "restaurant"]])},
+            {
+                "event": LayerConfig(
+                    fields=[],
+                    classes=None,
+                    rank=RankConfig(attribute="event_rank"),
+                    precedence=1,
+                )
+            },
+        ],
+        14,
+        1,
+        2,
+        None,
+    )
+
+    # Each partial source merges its own layers, ranked as configured
+    assert [attributes for _, attributes in decode_layer(merged, "poi")] == [
+        {"superclass": "amenity", "class": "school", "name": "S", "rank": 0},
+        {"superclass": "amenity", "class": "restaurant", "name": "A", "rank": 1},
+    ]
+    assert [attributes for _, attributes in decode_layer(merged, "event")] == [
+        {"name": "E0", "event_rank": 0},
+        {"name": "E1", "event_rank": 1},
+    ]
+
+
+def test_merge_tile_data_empty_partial():
+    full = encode_tile(
+        {
+            "poi": [
+                poi(10, 10, "amenity", "school", "S"),
+                poi(20, 20, "amenity", "restaurant", "R"),
+            ],
+            "road": [(1, 2, {"kind": "primary"})],
+        }
+    )
+    # Nothing of the merged classes
+    partial = encode_tile({"poi": [poi(30, 30, "amenity", "school", "P")]})
+    layers = [
+        {
+            "poi": poi_layer_config(
+                [["amenity", "restaurant"]],
+                precedence=1,
+                rank=RankConfig(attribute="top_rank"),
+            )
+        },
+        {"poi": poi_layer_config([["amenity", "restaurant"]], precedence=0)},
+    ]
+
+    # With a partial tile, ranked as configured by the highest precedence
+    # source, even without its tile
+    merged = merge_tile_data(full, [None, partial], layers, 14, 1, 2, None)
+    assert [attributes for _, attributes in decode_layer(merged, "poi")] == [
+        {"superclass": "amenity", "class": "school", "name": "S", "top_rank": 0},
+    ]
+    assert merged.raw_layer("road") == full.raw_layer("road")
+
+    # Without partial tile, the excluded classes are only removed
+    merged = merge_tile_data(full, [None, None], layers, 14, 1, 2, None)
+    assert [attributes for _, attributes in decode_layer(merged, "poi")] == [
+        {"superclass": "amenity", "class": "school", "name": "S"},
+    ]
+
+
+class SourceStatus(Source):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    async def tile(self, z, x, y, headers, url_params):
+        request = httpx.Request("GET", f"http://upstream/{z}/{x}/{y}.pbf")
+        raise httpx.HTTPStatusError(
+            "", request=request, response=httpx.Response(self.status_code)
+        )
+
+
+def test_merge_tile_partial_missing():
+    full = LazyTile(raw=b"full")
+
+    def merge_with(partial):
+        return asyncio.run(
+            merge_tile(
+                0,
+                SourceTiles({(1, 2): full}),
+                [partial],
+                [{}],
+                14,
+                1,
+                2,
+                headers={},
+                url_params="",
+                tile_in_poly=None,
+                degrade_partials=True,
+            )
+        )
+
+    # No partial tile, not a failure of the partial source
+    tile = merge_with(SourceStatus(404))
+    assert tile is full and not tile.degraded
+
+    tile = merge_with(SourceStatus(503))
+    assert tile is full and tile.degraded
@@ -0,0 +1,83 @@
+import asyncio
+
+import httpx
+from prometheus_client import REGISTRY
+
+from ..metadata import MetadataCache
+from ..sources import _http_clients, close_http_clients, fetch_json, upstream_config
+
+
+def test_metadata_cache_stale_while_refresh():
+    cache = MetadataCache(ttl=0)
+    documents = [{"v": 1}, {"v": 2}]
+
+    async def fetch():
+        return documents.pop(0)
+
+    async def run():
+        assert await cache.get("tilejson", fetch) == {"v": 1}
+        assert await cache.get("tilejson", fetch) == {"v": 1}
+        await asyncio.gather(*cache._tasks)
+        assert await cache.get("tilejson", fetch) == {"v": 2}
+        assert cache.misses == 1
+        assert cache.stale == 2
+
+    asyncio.run(run())
+
+
+def test_metadata_cache_keep_last_copy():
+    cache = MetadataCache(ttl=0)
+
+    async def fetch():
+        return {"v": 1}
+
+    async def fail():
+        raise IOError()
+
+    async def run():
+        await cache.get("style", fetch)
+        assert await cache.get("style", fail) == {"v": 1}
+        await asyncio.gather(*cache._tasks)
+        assert await cache.get("style", fail) == {"v": 1}
+        assert cache.errors == 1
+        assert "style" in cache.ages()
+
+    errors = REGISTRY.get_sample_value(
+        "vt_merge_metadata_cache_total", {"result": "error"}
+    )
+    asyncio.run(run())
+    assert (
+        REGISTRY.get_sample_value("vt_merge_metadata_cache_total", {"result": "error"})
+        == (errors or 0) + 1
+    )
+    assert REGISTRY.get_sample_value("vt_merge_metadata_cache_age_seconds") >= 0
+
+
+def test_metadata_cache_refresh_timeout(monkeypatch):
+    cache = MetadataCache(ttl=0)
+    delays = [10.0, 0]
+
+    async def handler(request):
+        await asyncio.sleep(delays.pop(0))
+        return httpx.Response(200, json={"v": 2})
+
+    async def run():
+        _http_clients["http://upstream"] = httpx.AsyncClient(
+            transport=httpx.MockTransport(handler)
+        )
+        url = "http://upstream/tilejson.json"
+        try:
+            await cache._fetch(url, lambda: asyncio.sleep(0, {"v": 1}))
+
+            # A hung upstream does not block the later refreshes
+            cache.refresh(url, lambda: fetch_json(url))
+            await asyncio.gather(*cache._tasks)
+            assert cache.errors == 1
+            cache.refresh(url, lambda: fetch_json(url))
+            await asyncio.gather(*cache._tasks)
+            assert await cache.get(url, lambda: fetch_json(url)) == {"v": 2}
+        finally:
+            await close_http_clients()
+
+    monkeypatch.setitem(upstream_config, "timeout", 0.05)
+    asyncio.run(run())
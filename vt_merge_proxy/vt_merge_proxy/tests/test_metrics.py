@@ -0,0 +1,60 @@
+import asyncio
+
+from prometheus_client import REGISTRY
+
+from ..metrics import count_tile, latest, recording, replay, stage, tile_labels
+
+
+def test_stage_labels():
+    async def merge():
+        with stage("decode"):
+            pass
+        count_tile(14, "merged")
+
+    async def run():
+        tile_labels.set(("localhost", "default"))
+        # Labels are inherited by the tasks
+        await asyncio.ensure_future(merge())
+
+    asyncio.run(run())
+
+    labels = {"host": "localhost", "data_id": "default"}
+    assert (
+        REGISTRY.get_sample_value(
+            "vt_merge_stage_seconds_count", {**labels, "stage": "decode"}
+        )
+        == 1
+    )
+    assert (
+        REGISTRY.get_sample_value(
+            "vt_merge_tiles_total", {**labels, "zoom": "14", "result": "merged"}
+        )
+        == 1
+    )
+    assert b"vt_merge_stage_seconds_bucket" in latest()
+
+
+def test_recording():
+    labels = {"host": "worker", "data_id": "default", "zoom": "15"}
+
+    def tiles():
+        return (
+            REGISTRY.get_sample_value(
+                "vt_merge_tiles_total", {**labels, "result": "merged"}
+            )
+            or 0
+        )
+
+    before = tiles()
+    with recording() as records:
+        count_tile(15, "merged")
+    assert records == [("tile", (15, "merged"))]
+    assert tiles() == before
+
+    # Observed with the labels of the replay context
+    async def run():
+        tile_labels.set(("worker", "default"))
+        replay(records)
+
+    asyncio.run(run())
+    assert tiles() == before + 1
@@ -0,0 +1,32 @@
+from ..mvt import split_layers
+
+
+def varint(value):
+    data = b""
+    while value > 0x7F:
+        data += bytes([value & 0x7F | 0x80])
+        value >>= 7
+    return data + bytes([value])
+
+
+def field(number, value: bytes):
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def layer(name, size):
+    version = bytes([15 << 3, 2])
+    extent = bytes([5 << 3]) + varint(4096)
+    point_feature = field(2, bytes([3 << 3, 1]))
+    return field(3, version + field(1, name.encode()) + extent + point_feature * size)
+
+
+def test_split_layers():
+    layers = [layer("transportation", 300), layer("poi", 10), layer("bâtiments", 0)]
+    tile = b"".join(layers)
+
+    assert split_layers(tile) == [
+        ("transportation", layers[0]),
+        ("poi", layers[1]),
+        ("bâtiments", layers[2]),
+    ]
+    assert split_layers(b"") == []
@@ -0,0 +1,83 @@
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+from ..mbtiles import MBTilesWriter
+from ..seed import bbox_tiles, blocks, seed
+
+BBOX = (-180.0, -85.0, 180.0, 85.0)
+
+
+def test_bbox_tiles():
+    assert list(bbox_tiles(0, (-180, -85, 180, 85))) == [(0, 0)]
+    assert set(bbox_tiles(1, (-10, -10, 10, 10))) == {(0, 0), (0, 1), (1, 0), (1, 1)}
+    assert list(bbox_tiles(14, (-1.0, 43.7, -1.0, 43.7))) == [(8146, 5976)]
+
+
+def test_blocks():
+    tiles = [(0, 0), (1, 1), (2, 0), (3, 3), (4, 4)]
+    assert blocks(tiles, 2) == [[(0, 0), (1, 1)], [(2, 0)], [(3, 3)], [(4, 4)]]
+
+
+def test_seed_xyz(tmp_path):
+    tiles = {
+        f"/1/{x}/{y}.pbf": gzip.compress(f"{x}/{y}".encode(), mtime=0)
+        for x in range(2)
+        for y in range(2)
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive connections, pooled by the HTTP clients
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/tilejson.json":
+                body = json.dumps({"tiles": [url + "/{z}/{x}/{y}.pbf"]}).encode()
+                headers = {"Content-Type": "application/json"}
+            else:
+                body = tiles[self.path]
+                headers = {"Content-Encoding": "gzip"}
+            self.send_response(200)
+            for key, value in {**headers, "Content-Length": len(body)}.items():
+                self.send_header(key, str(value))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    MBTilesWriter(str(tmp_path / "partial.mbtiles")).close()
+    config = {
+        "sources": {
+            "test": {
+                "hosts": ["localhost"],
+                "sources": {
+                    "full": {"tilejson_url": url + "/tilejson.json"},
+                    "partial": {"mbtiles": str(tmp_path / "partial.mbtiles")},
+                },
+                "merge_layers": {"poi": None},
+                "output": {"min_zoom": 14},
+            }
+        }
+    }
+    config_path = str(tmp_path / "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.dump(config, f)
+
+    try:
+        # Metadata fetched by the parent, tiles by the worker processes
+        seed(config_path, "test", str(tmp_path / "out"), 1, 1, processes=2, bbox=BBOX)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    for path, tile_data in tiles.items():
+        with open(str(tmp_path / "out") + path, "rb") as f:
+            assert f.read() == tile_data
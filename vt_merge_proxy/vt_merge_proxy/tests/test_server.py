@@ -0,0 +1,105 @@
+import asyncio
+import gzip
+import importlib
+import io
+import tarfile
+
+import httpx
+import pytest
+import yaml
+
+from ..mbtiles import MBTilesWriter
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    full = MBTilesWriter(str(tmp_path / "full.mbtiles"))
+    full.write_tiles(
+        14,
+        [
+            (x, y, gzip.compress(f"14/{x}/{y}".encode(), mtime=0))
+            for x, y in [(0, 0), (0, 1), (1, 1)]
+        ],
+    )
+    full.close()
+    MBTilesWriter(str(tmp_path / "partial.mbtiles")).close()
+
+    config = {
+        "sources": {
+            "test": {
+                "hosts": ["localhost"],
+                "sources": {
+                    "full": {"mbtiles": str(tmp_path / "full.mbtiles")},
+                    "partial": {"mbtiles": str(tmp_path / "partial.mbtiles")},
+                },
+                "merge_layers": {"poi": None},
+                "output": {"min_zoom": 14},
+            }
+        },
+        "server": {"metatile": {"max_depth": 1}},
+    }
+    with open(tmp_path / "config.yaml", "w") as f:
+        yaml.dump(config, f)
+    monkeypatch.setenv("CONFIG", str(tmp_path / "config.yaml"))
+
+    from .. import server
+
+    # Loads the config on import
+    return importlib.reload(server)
+
+
+def get(server, url: str, **kwargs) -> httpx.Response:
+    async def request():
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=server.app), base_url="http://localhost"
+        ) as client:
+            return await client.get(url, **kwargs)
+
+    return asyncio.run(request())
+
+
+def test_metatile(server):
+    r = get(server, "/data/test/13/0/0.tar?depth=1")
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/x-tar"
+
+    # Gzipped tiles, without the empty ones
+    with tarfile.open(fileobj=io.BytesIO(r.content)) as tar:
+        tiles = {
+            member.name: gzip.decompress(tar.extractfile(member).read())  # type: ignore
+            for member in tar.getmembers()
+        }
+    assert tiles == {
+        "14/0/0.pbf": b"14/0/0",
+        "14/0/1.pbf": b"14/0/1",
+        "14/1/1.pbf": b"14/1/1",
+    }
+
+    r = get(
+        server,
+        "/data/test/13/0/0.tar?depth=1",
+        headers={"If-None-Match": r.headers["etag"]},
+    )
+    assert r.status_code == 304
+
+
+def test_metatile_max_depth(server):
+    assert get(server, "/data/test/12/0/0.tar?depth=2").status_code == 400
+    assert get(server, "/data/other/13/0/0.tar?depth=1").status_code == 404
+
+
+def test_tile_not_modified(server):
+    headers = {"Accept-Encoding": "gzip"}
+    r = get(server, "/data/test/14/0/0.pbf", headers=headers)
+    assert r.status_code == 200
+    assert r.headers["content-encoding"] == "gzip"
+    etag = r.headers["etag"]
+
+    # Known ETag, then merged again
+    for _ in range(2):
+        r = get(
+            server, "/data/test/14/0/0.pbf", headers={**headers, "If-None-Match": etag}
+        )
+        assert r.status_code == 304
+        assert r.headers["etag"] == etag
+        server.tile_etags._entries.clear()
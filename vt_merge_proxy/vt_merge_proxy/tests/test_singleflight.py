@@ -0,0 +1,43 @@
+import asyncio
+
+from ..singleflight import SingleFlight
+
+
+def test_single_flight():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(True)
+        await asyncio.sleep(0.01)
+        return b"tile"
+
+    async def run():
+        results = await asyncio.gather(
+            *[single_flight.do((14, 1, 2), fetch) for _ in range(10)]
+        )
+        assert results == [b"tile"] * 10
+        assert len(calls) == 1
+        assert len(single_flight) == 0
+
+        await single_flight.do((14, 1, 2), fetch)
+        assert len(calls) == 2
+
+    asyncio.run(run())
+
+
+def test_single_flight_cancelled_caller():
+    single_flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        return b"tile"
+
+    async def run():
+        first = asyncio.ensure_future(single_flight.do("key", fetch))
+        second = asyncio.ensure_future(single_flight.do("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == b"tile"
+
+    asyncio.run(run())
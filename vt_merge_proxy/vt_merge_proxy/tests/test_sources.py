@@ -1,4 +1,19 @@
-from ..sources import SourceTileJSON
+import asyncio
+
+import httpx
+import pytest
+
+from ..circuit import CircuitOpenError
+from ..sources import (
+    DeadlineExceeded,
+    SourceTileJSON,
+    SourceXYZ,
+    _http_clients,
+    close_http_clients,
+    forward_headers,
+    set_deadline,
+    upstream_config,
+)
 
 
 def test_tilejson():
@@ -14,3 +29,154 @@ def test_tilejson_tile_url():
     )
 
     assert source.template_url.startswith("http://localhost:3000")
+
+
+def test_xyz_negative_cache():
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        if request.url.path == "/14/1/1.pbf":
+            status_code = 204
+        elif request.url.path == "/14/1/2.pbf":
+            status_code = 404
+        else:
+            status_code = 503
+        return httpx.Response(status_code, stream=httpx.ByteStream(b""))
+
+    async def run():
+        _http_clients["http://upstream"] = httpx.AsyncClient(
+            transport=httpx.MockTransport(handler)
+        )
+        source = SourceXYZ("http://upstream/{z}/{x}/{y}.pbf")
+        source.circuit_breaker.failure_threshold = 2
+        try:
+            for _ in range(2):
+                assert await source.tile(14, 1, 1, {}, "") is None
+                with pytest.raises(httpx.HTTPStatusError):
+                    await source.tile(14, 1, 2, {}, "")
+            assert calls == ["/14/1/1.pbf", "/14/1/2.pbf"]
+
+            # Retried twice, a single failure of the upstream
+            for y in (3, 4):
+                with pytest.raises(httpx.HTTPStatusError):
+                    await source.tile(14, 1, y, {}, "")
+            assert len(calls) == 2 + 3 * 2
+            with pytest.raises(CircuitOpenError):
+                await source.tile(14, 1, 5, {}, "")
+            assert len(calls) == 2 + 3 * 2
+        finally:
+            await close_http_clients()
+
+    asyncio.run(run())
+
+
+def test_xyz_mirrors():
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.host)
+        if request.url.path == "/14/1/1.pbf" and request.url.host == "a":
+            return httpx.Response(503, stream=httpx.ByteStream(b""))
+        elif request.url.host == "a":
+            await asyncio.sleep(1)
+        return httpx.Response(200, stream=httpx.ByteStream(request.url.host.encode()))
+
+    async def run():
+        for host in ("a", "b"):
+            _http_clients[f"http://{host}"] = httpx.AsyncClient(
+                transport=httpx.MockTransport(handler)
+            )
+        source = SourceXYZ(["http://a/{z}/{x}/{y}.pbf", "http://b/{z}/{x}/{y}.pbf"])
+        try:
+            # Retried on the next mirror
+            assert (await source.tile(14, 1, 1, {}, "")).raw == b"b"
+            assert calls == ["a", "b"]
+
+            # Hedged on the next mirror
+            source._latencies.extend([0.01] * 20)
+            assert (await source.tile(14, 1, 2, {}, "")).raw == b"b"
+            assert calls == ["a", "b", "a", "b"]
+
+            # Not retried after the deadline
+            set_deadline(0.1)
+            source._latencies.clear()
+            with pytest.raises(httpx.TimeoutException):
+                await source.tile(14, 1, 3, {}, "")
+            assert calls[4:] == ["a"]
+        finally:
+            await close_http_clients()
+
+    asyncio.run(run())
+
+
+def test_forward_headers():
+    assert forward_headers(
+        {
+            "Accept-Encoding": "gzip",
+            "Connection": "keep-alive",
+            "If-None-Match": '"etag"',
+            "If-Modified-Since": "Sun, 18 Oct 2026 10:00:00 GMT",
+            "User-Agent": "test",
+        },
+        drop={"accept-encoding"},
+    ) == {"User-Agent": "test"}
+
+
+def test_xyz_deadline():
+    delays = {"/14/1/1.pbf": 1.0}
+
+    async def handler(request):
+        await asyncio.sleep(delays.get(request.url.path, 0))
+        return httpx.Response(200, stream=httpx.ByteStream(b"tile"))
+
+    async def run():
+        _http_clients["http://upstream"] = httpx.AsyncClient(
+            transport=httpx.MockTransport(handler)
+        )
+        source = SourceXYZ("http://upstream/{z}/{x}/{y}.pbf")
+        source.circuit_breaker.failure_threshold = 1
+        try:
+            # Cut short, or spent before the fetch
+            set_deadline(0.05)
+            with pytest.raises(DeadlineExceeded):
+                await source.tile(14, 1, 1, {}, "")
+            set_deadline(-1)
+            with pytest.raises(DeadlineExceeded):
+                await source.tile(14, 1, 2, {}, "")
+
+            # Neither cached nor counted as failures of the upstream
+            set_deadline(None)
+            delays.clear()
+            assert source.circuit_breaker.state == "closed"
+            assert (await source.tile(14, 1, 1, {}, "")).raw == b"tile"
+            assert (await source.tile(14, 1, 2, {}, "")).raw == b"tile"
+        finally:
+            await close_http_clients()
+
+    asyncio.run(run())
+
+
+def test_xyz_negative_cache_disabled(monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        return httpx.Response(404, stream=httpx.ByteStream(b""))
+
+    async def run():
+        _http_clients["http://upstream"] = httpx.AsyncClient(
+            transport=httpx.MockTransport(handler)
+        )
+        source = SourceXYZ("http://upstream/{z}/{x}/{y}.pbf")
+        try:
+            for _ in range(2):
+                with pytest.raises(httpx.HTTPStatusError):
+                    await source.tile(14, 1, 1, {}, "")
+            assert len(calls) == 2
+        finally:
+            await close_http_clients()
+
+    monkeypatch.setitem(upstream_config, "negative_ttl", 0)
+    monkeypatch.setitem(upstream_config, "error_ttl", 0)
+    asyncio.run(run())
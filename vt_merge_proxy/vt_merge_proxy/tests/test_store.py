@@ -0,0 +1,65 @@
+import asyncio
+
+from ..sources import LazyTile
+from ..store import TileStore
+
+
+def test_tile_store(tmp_path):
+    store = TileStore(str(tmp_path / "store.sqlite"))
+    merged = []
+
+    async def merge():
+        merged.append(True)
+        return LazyTile(b"tile", etag="merged")
+
+    async def run():
+        key = ("default", 14, 1, 2, "")
+        assert (await store.get(key, "1", merge)).raw == b"tile"
+        tile = await store.get(key, "1", merge)
+        assert tile.raw == b"tile"
+        # Same etag as the merged tile
+        assert tile.etag == "merged"
+        assert len(merged) == 1
+
+        # New version, stored tile is invalidated
+        assert (await store.get(key, "2", merge)).raw == b"tile"
+        assert len(merged) == 2
+
+    asyncio.run(run())
+
+
+def test_tile_store_stale_while_revalidate(tmp_path):
+    store = TileStore(str(tmp_path / "store.sqlite"), ttl=0)
+    tiles = [b"old", b"new", b"new"]
+
+    async def merge():
+        return LazyTile(tiles.pop(0))
+
+    async def run():
+        key = ("default", 14, 1, 2, "")
+        assert (await store.get(key, "1", merge)).raw == b"old"
+        assert (await store.get(key, "1", merge)).raw == b"old"
+        await asyncio.gather(*store._tasks)
+        assert (await store.get(key, "1", merge)).raw == b"new"
+
+    asyncio.run(run())
+
+
+def test_tile_store_purge(tmp_path):
+    store = TileStore(str(tmp_path / "store.sqlite"), max_size=2, purge_interval=0)
+
+    async def merge():
+        return LazyTile(b"tile")
+
+    async def run():
+        for x in range(4):
+            await store.get(("default", 14, x, 0, ""), "1", merge)
+
+    asyncio.run(run())
+    rows = store._connection().execute("SELECT tile_column FROM tiles").fetchall()
+    # Oldest tiles removed
+    assert sorted(rows) == [(2,), (3,)]
+
+    store = TileStore(str(tmp_path / "store.sqlite"), max_age=0)
+    store.purge()
+    assert store._connection().execute("SELECT count(*) FROM tiles").fetchone() == (0,)
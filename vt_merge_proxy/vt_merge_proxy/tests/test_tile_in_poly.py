@@ -0,0 +1,94 @@
+import io
+import json
+import math
+
+from shapely.geometry import Point  # type: ignore
+
+from ..tile_in_poly import BOUNDARY, INSIDE, OUTSIDE, TileInPoly
+
+POLYGON = {
+    "type": "Polygon",
+    "coordinates": [
+        [
+            [-1.10, 43.68],
+            [-1.00, 43.68],
+            [-1.02, 43.74],
+            [-1.08, 43.75],
+            [-1.10, 43.68],
+        ]
+    ],
+}
+
+
+def tile(z, lon, lat):
+    n = 2 ** z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return x, y
+
+
+def test_tile_coverage_index():
+    tile_in_poly = TileInPoly(io.StringIO(json.dumps(POLYGON)), index_max_zoom=12)
+
+    coverages = set()
+    for z in range(8, 15):
+        x_min, y_min = tile(z, -1.12, 43.76)
+        x_max, y_max = tile(z, -0.98, 43.66)
+        for x in range(x_min - 1, x_max + 2):
+            for y in range(y_min - 1, y_max + 2):
+                coverage = tile_in_poly.tile_coverage(z, x, y)
+                assert coverage == tile_in_poly._tile_geometry_coverage(z, x, y)
+                coverages.add(coverage)
+
+    assert coverages == {OUTSIDE, INSIDE, BOUNDARY}
+    assert tile_in_poly.is_tile_outside_poly(0, 0, 0) is False
+    assert tile_in_poly.is_tile_outside_poly(14, 0, 0) is True
+
+
+def test_tiles():
+    tile_in_poly = TileInPoly(io.StringIO(json.dumps(POLYGON)), index_max_zoom=12)
+
+    for z in (10, 14):
+        x_min, y_min = tile(z, -1.12, 43.76)
+        x_max, y_max = tile(z, -0.98, 43.66)
+        expected = {
+            (x, y)
+            for x in range(x_min, x_max + 1)
+            for y in range(y_min, y_max + 1)
+            if not tile_in_poly.is_tile_outside_poly(z, x, y)
+        }
+        assert set(tile_in_poly.tiles(z)) == expected
+
+
+def test_points_in_poly():
+    tile_in_poly = TileInPoly(io.StringIO(json.dumps(POLYGON)))
+
+    z = 14
+    x, y = tile(z, -1.0, 43.68)  # Boundary tile
+    points = [(fx, fy) for fx in range(-512, 4608, 64) for fy in range(-512, 4608, 64)]
+    mask = tile_in_poly.points_in_poly(z, x, y, points)
+
+    x_base, y_base = tile_in_poly.marcator.TileBounds(x, y, z)[0:2]
+    scale = tile_in_poly.PIXEL * tile_in_poly.marcator.Resolution(z) / 4096
+    expected = [
+        tile_in_poly.polygon.contains(
+            Point(x_base + fx * scale, -(y_base + fy * scale))
+        )
+        for fx, fy in points
+    ]
+    assert mask.tolist() == expected
+    assert any(expected) and not all(expected)
+
+
+def test_tiles_coverage():
+    tile_in_poly = TileInPoly(io.StringIO(json.dumps(POLYGON)), index_max_zoom=12)
+
+    for z in (10, 14):
+        x_min, y_min = tile(z, -1.12, 43.76)
+        x_max, y_max = tile(z, -0.98, 43.66)
+        tiles = [
+            (x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)
+        ]
+        assert tile_in_poly.tiles_coverage(z, tiles) == {
+            (x, y): tile_in_poly.tile_coverage(z, x, y) for x, y in tiles
+        }
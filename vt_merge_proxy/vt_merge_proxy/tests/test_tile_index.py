@@ -0,0 +1,27 @@
+from ..tile_index import TileIndex
+
+
+def test_tile_index():
+    index = TileIndex.from_tiles("1", [(14, 1, 2), (14, 3, 3), (2, 3, 1), (14, 1, 2)])
+
+    assert len(index) == 3
+    assert (14, 1, 2) in index
+    assert (14, 3, 3) in index
+    assert (2, 3, 1) in index
+    assert (14, 2, 1) not in index
+    assert (14, 16383, 16383) not in index
+    assert (13, 1, 2) not in index
+
+
+def test_tile_index_file(tmp_path):
+    path = str(tmp_path / "test.mbtiles.index.npz")
+    TileIndex.from_tiles("1", [(14, 1, 2), (2, 3, 1)]).save(path)
+
+    index = TileIndex.load(path, "1")
+    assert index is not None
+    assert len(index) == 2
+    assert (14, 1, 2) in index
+
+    # Of an other version of the source
+    assert TileIndex.load(path, "2") is None
+    assert TileIndex.load(str(tmp_path / "missing.npz"), "1") is None
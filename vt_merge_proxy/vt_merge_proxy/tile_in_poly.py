@@ -1,18 +1,26 @@
+import functools
 import json
+from typing import Dict, Iterable, Iterator, List, Tuple
 
+import numpy as np
 import pyproj  # type: ignore
-from shapely.geometry import LineString  # type: ignore
-from shapely.geometry import GeometryCollection, Point, shape  # type: ignore
+import shapely  # type: ignore
+from shapely.geometry import GeometryCollection, box, shape  # type: ignore
 from shapely.ops import transform  # type: ignore
 
 from .globalmaptiles import GlobalMercator
 
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
 
 class TileInPoly:
     PIXEL = 512
     WIDTH = 4096
+    LOCAL_MARGIN = 0.25
 
-    def __init__(self, geosjon):
+    def __init__(self, geosjon, index_max_zoom: int = 14):
         j = json.load(geosjon)
         if j.get("type") == "FeatureCollection":
             features = j["features"]
@@ -27,28 +35,137 @@ class TileInPoly:
 
         project = pyproj.Transformer.from_crs(wgs84, wmer, always_xy=True).transform
         self.polygon = transform(project, self.polygon)
+        shapely.prepare(self.polygon)
+        self._local_polygons = functools.lru_cache(maxsize=1024)(self._local_polygon)
 
         self.marcator = GlobalMercator(self.PIXEL)
 
-    def is_tile_outside_poly(self, z, x, y):
-        bound = self.marcator.TileBounds(x, y, z)
-        bound = LineString(((bound[0], -bound[1]), (bound[2], -bound[3]))).envelope
-        return not self.polygon.intersection(bound)
+        self.index_max_zoom = index_max_zoom
+        self._coverage: Dict[Tuple[int, int, int], int] = {}
+        self._build_coverage()
 
-    def is_tile_inside_poly(self, z, x, y):
+    def _tile_bound(self, z, x, y):
         bound = self.marcator.TileBounds(x, y, z)
-        bound = LineString(((bound[0], -bound[1]), (bound[2], -bound[3]))).envelope
-        return self.polygon.contains(bound)
+        return box(bound[0], -bound[3], bound[2], -bound[1])
 
-    def point_in_poly(self, z, x, y):
-        x_base, y_base = self.marcator.TileBounds(x, y, z)[0:2]
-        res = self.marcator.Resolution(z)
+    def _tile_geometry_coverage(self, z, x, y):
+        bound = self._tile_bound(z, x, y)
+        if not shapely.intersects(self.polygon, bound):
+            return OUTSIDE
+        elif shapely.contains(self.polygon, bound):
+            return INSIDE
+        else:
+            return BOUNDARY
+
+    def _build_coverage(self):
+        """
+        Quadtree of the tiles coverage, only the boundary tiles are split.
+        """
+        tiles = [(0, 0, 0)]
+        while tiles:
+            z, x, y = tiles.pop()
+            coverage = self._tile_geometry_coverage(z, x, y)
+            self._coverage[(z, x, y)] = coverage
+            if coverage == BOUNDARY and z < self.index_max_zoom:
+                for dx in (0, 1):
+                    for dy in (0, 1):
+                        tiles.append((z + 1, x * 2 + dx, y * 2 + dy))
+
+    def tile_coverage(self, z, x, y):
+        if z > self.index_max_zoom:
+            shift = z - self.index_max_zoom
+            coverage = self.tile_coverage(self.index_max_zoom, x >> shift, y >> shift)
+            if coverage == BOUNDARY:
+                return self._tile_geometry_coverage(z, x, y)
+            else:
+                return coverage
+
+        # Tiles not in the index are fully inside or outside one of their
+        # parent.
+        while (z, x, y) not in self._coverage:
+            z, x, y = z - 1, x >> 1, y >> 1
+        return self._coverage[(z, x, y)]
+
+    def tiles_coverage(
+        self, z: int, tiles: Iterable[Tuple[int, int]]
+    ) -> Dict[Tuple[int, int], int]:
+        """
+        Coverage of many tiles of a zoom level. The tiles beyond the index
+        with a boundary parent are tested against the polygon at once.
+        """
+        coverages: Dict[Tuple[int, int], int] = {}
+        boundaries: List[Tuple[int, int]] = []
+        shift = max(z - self.index_max_zoom, 0)
+        for x, y in tiles:
+            coverage = self.tile_coverage(z - shift, x >> shift, y >> shift)
+            if shift and coverage == BOUNDARY:
+                boundaries.append((x, y))
+            else:
+                coverages[(x, y)] = coverage
 
-        def is_point_in_poly(fx, fy):
-            point = Point(
-                x_base + fx * self.PIXEL * res / self.WIDTH,
-                -(y_base + fy * self.PIXEL * res / self.WIDTH),
+        if boundaries:
+            bounds = np.array(
+                [self.marcator.TileBounds(x, y, z) for x, y in boundaries]
             )
-            return self.polygon.contains(point)
+            boxes = shapely.box(
+                bounds[:, 0], -bounds[:, 3], bounds[:, 2], -bounds[:, 1]
+            )
+            intersects = shapely.intersects(self.polygon, boxes)
+            contains = shapely.contains(self.polygon, boxes)
+            for tile, intersect, contain in zip(boundaries, intersects, contains):
+                coverages[tile] = (
+                    OUTSIDE if not intersect else INSIDE if contain else BOUNDARY
+                )
+        return coverages
+
+    def is_tile_outside_poly(self, z, x, y):
+        return self.tile_coverage(z, x, y) == OUTSIDE
+
+    def is_tile_inside_poly(self, z, x, y):
+        return self.tile_coverage(z, x, y) == INSIDE
+
+    def tiles(self, z: int) -> Iterator[Tuple[int, int]]:
+        """
+        Tiles of a zoom level not outside the polygon, from the quadtree.
+        """
+        parents = [(0, 0, 0)]
+        while parents:
+            pz, px, py = parents.pop()
+            if self.tile_coverage(pz, px, py) == OUTSIDE:
+                continue
+            elif pz == z:
+                yield (px, py)
+            else:
+                for dx in (0, 1):
+                    for dy in (0, 1):
+                        parents.append((pz + 1, px * 2 + dx, py * 2 + dy))
+
+    def _local_polygon(self, z, x, y):
+        """
+        Polygon clipped to the tile, with a margin for the tile buffer.
+        """
+        x_min, y_min, x_max, y_max = self._tile_bound(z, x, y).bounds
+        margin = (x_max - x_min) * self.LOCAL_MARGIN
+        bound = box(x_min - margin, y_min - margin, x_max + margin, y_max + margin)
+        local_polygon = self.polygon.intersection(bound)
+        shapely.prepare(local_polygon)
+        return bound, local_polygon
+
+    def points_in_poly(self, z, x, y, points) -> np.ndarray:
+        """
+        Test tile coordinates points against the polygon. Returns a boolean mask.
+        """
+        x_base, y_base = self.marcator.TileBounds(x, y, z)[0:2]
+        scale = self.PIXEL * self.marcator.Resolution(z) / self.WIDTH
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        mx = x_base + points[:, 0] * scale
+        my = -(y_base + points[:, 1] * scale)
 
-        return is_point_in_poly
+        bound, local_polygon = self._local_polygons(z, x, y)
+        x_min, y_min, x_max, y_max = bound.bounds
+        local = (x_min < mx) & (mx < x_max) & (y_min < my) & (my < y_max)
+        mask = np.empty(len(points), dtype=bool)
+        mask[local] = shapely.contains_xy(local_polygon, mx[local], my[local])
+        # Points far in the buffer, out of the local polygon
+        mask[~local] = shapely.contains_xy(self.polygon, mx[~local], my[~local])
+        return mask
@@ -0,0 +1,62 @@
+import os
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+class TileIndex:
+    """
+    Tiles present in a source. For each zoom level, a sorted array of the
+    x * 2^z + y codes of the tiles, looked up by binary search. The version is
+    the one of the indexed source.
+    """
+
+    def __init__(self, version: str, zooms: Dict[int, np.ndarray]):
+        self.version = version
+        self.zooms = zooms
+
+    @classmethod
+    def from_tiles(cls, version: str, tiles: Iterable[Tuple[int, int, int]]):
+        codes: Dict[int, List[int]] = defaultdict(list)
+        for z, x, y in tiles:
+            codes[z].append((x << z) + y)
+        return cls(
+            version,
+            {z: np.unique(np.array(c, dtype=np.uint64)) for z, c in codes.items()},
+        )
+
+    def __len__(self):
+        return sum(len(codes) for codes in self.zooms.values())
+
+    def __contains__(self, tile: Tuple[int, int, int]) -> bool:
+        z, x, y = tile
+        codes = self.zooms.get(z)
+        if codes is None:
+            return False
+        code = np.uint64((x << z) + y)
+        i = np.searchsorted(codes, code)
+        return bool(i < len(codes) and codes[i] == code)
+
+    def save(self, path: str):
+        # Complete files only, written by concurrent processes
+        tmp = f"{path}.{os.getpid()}.tmp"
+        arrays: Dict[str, Any] = {f"z{z}": codes for z, codes in self.zooms.items()}
+        with open(tmp, "wb") as f:
+            np.savez(f, version=np.array(self.version), **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, version: str) -> Optional["TileIndex"]:
+        """
+        None when the file is missing or of an other version.
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if str(data["version"]) != version:
+                return None
+            return cls(
+                version,
+                {int(key[1:]): data[key] for key in data.files if key.startswith("z")},
+            )